@@ -1,74 +1,259 @@
-from fastapi import FastAPI, HTTPException, Query
-from typing import List
+import os
+import time
+from contextlib import asynccontextmanager
 
-from models.media_item import Library, TVShow, Season, Episode, Movie, Subtitle
-from services.subtitle_parser import SubtitleParser
-from services.file_parser import FileParser
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import TypeAdapter
+from typing import Callable, List, Optional
 
-api = FastAPI()
+from models.media_item import Library
+from models.search import SearchHit
+from models.subtitle import CueEntry, Subtitle, SubtitleDetail
+from models.summary import EpisodeSummary, MovieSummary, SeasonSummary, TVShowSummary
+from services.cue_export import UNITS, CueExporter, ExportItem, InvalidCursor
+from services.cue_offsets import CueOffsetStore
+from services.response_cache import ResponseCache
+from services.subtitle_cache import subtitle_cache
+from services.library_store import LibraryStore, RescanInProgress, RescanStatus
+from services.scan_index import ScanIndex
+from services.search_index import SearchIndex
+from utils.metrics import http_request_seconds, registry
 
-from fastapi.middleware.cors import CORSMiddleware
+LIBRARY_DIR = os.environ.get("MEEDYA_LIBRARY_DIR", r'/mnt/f/TV')
+
+# One parser and parse cache for the scan, search index, merges and cue API.
+subtitle_parser = subtitle_cache.parser
+search_index = SearchIndex(subtitle_cache)
+store = LibraryStore(LIBRARY_DIR, subtitle_parser, index=ScanIndex(), search_index=search_index)
+
+
+# The library is scanned in the background after startup; until it is ready
+# the endpoints serve the previous (initially empty) snapshot. Setting
+# MEEDYA_WATCH=1 then keeps it current from filesystem events.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    store.start_rescan(full_rebuild=os.environ.get("MEEDYA_FULL_REBUILD") == "1")
+    watcher = None
+    if os.environ.get("MEEDYA_WATCH") == "1":
+        from services.library_watcher import LibraryWatcher
+        watcher = LibraryWatcher(store, auto_merge=os.environ.get("MEEDYA_AUTO_MERGE") == "1")
+        watcher.start()
+    yield
+    if watcher is not None:
+        watcher.stop()
+
+
+api = FastAPI(lifespan=lifespan)
+
+from fastapi.middleware.cors import CORSMiddleware
 api.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"],
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
-library = Library(movies=[], tv_shows=[])
+@api.middleware("http")
+async def record_latency(request: Request, call_next):
+    # Labelled by route template rather than path, so /tvshows/{tvshow_name}
+    # is one series however many shows there are.
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    http_request_seconds.observe(
+        time.perf_counter() - started,
+        method=request.method, route=getattr(route, "path", "unmatched"), status=str(response.status_code),
+    )
+    return response
+
+
+response_cache = ResponseCache()
+cue_offsets = CueOffsetStore(subtitle_parser)
+cue_exporter = CueExporter(subtitle_parser)
+
+tv_show_list = TypeAdapter(List[TVShowSummary])
+season_list = TypeAdapter(List[SeasonSummary])
+episode_list = TypeAdapter(List[EpisodeSummary])
+movie_list = TypeAdapter(List[MovieSummary])
 
-subtitle_parser = SubtitleParser()
-file_parser = FileParser(library, subtitle_parser)
 
-file_parser.parse(r'/mnt/f/TV')
+def cached_response(request: Request, library: Library, render: Callable[[], bytes]) -> Response:
+    # List responses are serialized once per library generation and query, and
+    # revalidated by ETag so unchanged pages come back as 304s.
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+    body, etag = response_cache.get(library.generation, key, render)
 
+    if_none_match = request.headers.get("if-none-match", "")
+    if any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
-@api.get("/movies", response_model=List[Movie])
-def list_movies(skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
-    return library.movies[skip: skip + limit]
 
+@api.get("/movies", response_model=List[MovieSummary])
+def list_movies(request: Request, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
+    library = store.library
+    return cached_response(request, library, lambda: movie_list.dump_json(
+        [MovieSummary.of(movie) for movie in library.movies[skip: skip + limit]]
+    ))
 
-@api.get("/tvshows", response_model=List[TVShow])
-def list_tv_shows(skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
-    return library.tv_shows[skip: skip + limit]
 
+@api.get("/tvshows", response_model=List[TVShowSummary])
+def list_tv_shows(request: Request, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
+    library = store.library
+    return cached_response(request, library, lambda: tv_show_list.dump_json(
+        [TVShowSummary.of(show) for show in library.tv_shows[skip: skip + limit]]
+    ))
 
-@api.get("/tvshows/{tvshow_name}/seasons", response_model=List[Season])
-def list_seasons(tvshow_name: str, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
-    tvshow = next((show for show in library.tv_shows if show.name == tvshow_name), None)
+
+@api.get("/tvshows/{tvshow_name}/seasons", response_model=List[SeasonSummary])
+def list_seasons(request: Request, tvshow_name: str, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
+    library = store.library
+    tvshow = library.get_tv_show(tvshow_name)
     if not tvshow:
         raise HTTPException(status_code=404, detail="TV Show not found")
-    return tvshow.seasons[skip: skip + limit]
+    return cached_response(request, library, lambda: season_list.dump_json(
+        [SeasonSummary.of(season) for season in tvshow.seasons[skip: skip + limit]]
+    ))
 
 
-@api.get("/tvshows/{tvshow_name}/seasons/{season_name}/episodes", response_model=List[Episode])
-def list_episodes(tvshow_name: str, season_name: str, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
-    tvshow = next((show for show in library.tv_shows if show.name == tvshow_name), None)
-    if not tvshow:
+@api.get("/tvshows/{tvshow_name}/seasons/{season_name}/episodes", response_model=List[EpisodeSummary])
+def list_episodes(request: Request, tvshow_name: str, season_name: str, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
+    library = store.library
+    if not library.get_tv_show(tvshow_name):
         raise HTTPException(status_code=404, detail="TV Show not found")
 
-    season = next((s for s in tvshow.seasons if s.name == season_name), None)
+    season = library.get_season(tvshow_name, season_name)
     if not season:
         raise HTTPException(status_code=404, detail="Season not found")
 
-    return season.episodes[skip: skip + limit]
+    return cached_response(request, library, lambda: episode_list.dump_json(
+        [EpisodeSummary.of(episode) for episode in season.episodes[skip: skip + limit]]
+    ))
+
+
+@api.get("/tvshows/{tvshow_name}/episodes/{episode_code}", response_model=List[EpisodeSummary])
+def find_episodes(request: Request, tvshow_name: str, episode_code: str):
+    library = store.library
+    if not library.get_tv_show(tvshow_name):
+        raise HTTPException(status_code=404, detail="TV Show not found")
 
+    episodes = library.find_episodes(tvshow_name, episode_code)
+    if not episodes:
+        raise HTTPException(status_code=404, detail="Episode not found")
+    return cached_response(request, library, lambda: episode_list.dump_json(
+        [EpisodeSummary.of(episode) for episode in episodes]
+    ))
 
 
-@api.get("/episodes/{episode_name}/subtitles", response_model=List[Subtitle])
+@api.get("/episodes/{episode_name}/subtitles", response_model=List[SubtitleDetail])
 def list_subtitles(episode_name: str, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
-    for tvshow in library.tv_shows:
-        for season in tvshow.seasons:
-            for episode in season.episodes:
-                if episode.name == episode_name:
-                    return episode.subtitles[skip: skip + limit]
-    raise HTTPException(status_code=404, detail="Episode not found")
+    library = store.library
+    episode = library.get_episode(episode_name)
+    if not episode:
+        raise HTTPException(status_code=404, detail="Episode not found")
+    return subtitle_details(episode.subtitles[skip: skip + limit])
 
 
-@api.get("/movies/{movie_name}/subtitles", response_model=List[Subtitle])
+@api.get("/movies/{movie_name}/subtitles", response_model=List[SubtitleDetail])
 def list_movie_subtitles(movie_name: str, skip: int = Query(0, ge=0), limit: int = Query(10, ge=1)):
-    movie = next((m for m in library.movies if m.name == movie_name), None)
+    library = store.library
+    movie = library.get_movie(movie_name)
     if not movie:
         raise HTTPException(status_code=404, detail="Movie not found")
-    return movie.subtitles[skip: skip + limit]
+    return subtitle_details(movie.subtitles[skip: skip + limit])
+
+
+def subtitle_details(subtitles: List[Subtitle]) -> List[SubtitleDetail]:
+    # A subtitle deleted since the last scan is a 404, as for its cues.
+    try:
+        return [subtitle.detail() for subtitle in subtitles]
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Subtitle file not found")
+
+
+@api.get("/subtitles/{subtitle_id}/cues", response_model=List[CueEntry])
+def list_cues(subtitle_id: str, from_ms: int = Query(0, ge=0), to_ms: Optional[int] = Query(None, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    # Only the cues in the window are read from the file, via its offset index.
+    subtitle = store.library.get_subtitle(subtitle_id)
+    if not subtitle:
+        raise HTTPException(status_code=404, detail="Subtitle not found")
+    try:
+        cues = cue_offsets.window(subtitle.file_path, from_ms, to_ms, limit)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Subtitle file not found")
+    return [CueEntry(index=index, start_ms=start, end_ms=end, text=text) for index, start, end, text in cues]
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    # Whether an Accept-Encoding header allows gzip, by name or through "*";
+    # q=0 refuses a coding.
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def export_response(request: Request, items: List[ExportItem], unit: str, cursor: Optional[str], compress: Optional[bool]) -> StreamingResponse:
+    # NDJSON streamed as it is produced. gzip is used when asked for with
+    # ?gzip=true or, by default, when the client accepts it. A broken-off
+    # export is resumed by passing the cursor of the last line received;
+    # byte ranges are not offered, since the length is unknown until the end.
+    try:
+        start = cue_exporter.resume_point(items, cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if compress is None:
+        compress = accepts_gzip(request.headers.get("accept-encoding", ""))
+    headers = {"Accept-Ranges": "none"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(cue_exporter.stream(items, unit, start, compress), media_type="application/x-ndjson", headers=headers)
+
+
+@api.get("/export/cues")
+def export_library(request: Request, unit: str = Query("cue", pattern=f"^({'|'.join(UNITS)})$"), cursor: Optional[str] = None, gzip: Optional[bool] = None):
+    return export_response(request, cue_exporter.items(store.library), unit, cursor, gzip)
+
+
+@api.get("/tvshows/{tvshow_name}/seasons/{season_name}/export")
+def export_season(request: Request, tvshow_name: str, season_name: str, unit: str = Query("cue", pattern=f"^({'|'.join(UNITS)})$"), cursor: Optional[str] = None, gzip: Optional[bool] = None):
+    library = store.library
+    if not library.get_season(tvshow_name, season_name):
+        raise HTTPException(status_code=404, detail="Season not found")
+    return export_response(request, cue_exporter.items(library, show=tvshow_name, season=season_name), unit, cursor, gzip)
+
+
+@api.get("/search", response_model=List[SearchHit])
+def search(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=200)):
+    return search_index.search(q, limit)
+
+
+@api.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text format: stage timings, event counts and request latency.
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@api.get("/rescan", response_model=RescanStatus)
+def rescan_status():
+    return store.status
+
+
+@api.post("/rescan", response_model=RescanStatus, status_code=202)
+def rescan(show: Optional[str] = None, full: bool = False):
+    try:
+        return store.start_rescan(show=show, full_rebuild=full)
+    except RescanInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
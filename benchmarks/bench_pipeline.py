@@ -0,0 +1,247 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import generate_library, generate_pair
+from models.media_item import Library
+from models.subtitle import Subtitle
+from services.file_parser import FileParser
+from services.scan_index import ScanIndex
+from services.subtitle_aligner import AlignMode, SubtitleAligner
+from services.subtitle_merger import SubtitleMerger
+from services.subtitle_parser import SubtitleParser
+from utils.logger import logger
+
+# name -> {"seconds", "throughput", "unit", "peak_kib"}
+Results = Dict[str, dict]
+
+# Entry points whose cold import time is tracked, and the budget each must
+# stay under: a CLI invocation or test collection should start well under a
+# second, and the API is bounded by FastAPI's own import.
+IMPORT_BUDGETS = {"main": 0.25, "subtitles": 0.5, "api": 1.0}
+
+
+def measure(results: Results, name: str, run: Callable[[], object], units: int, unit: str, rounds: int, memory: bool) -> None:
+    # Peak memory comes from one traced run, timings from untraced ones
+    # (tracemalloc slows allocation-heavy code several times over).
+    peak_kib = None
+    if memory:
+        tracemalloc.start()
+        run()
+        peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+
+    record(results, name, statistics.median(times), units, unit, peak_kib)
+
+
+def record(results: Results, name: str, seconds: float, units: int, unit: str, peak_kib: Optional[float] = None) -> None:
+    results[name] = {"seconds": seconds, "throughput": units / max(seconds, 1e-9), "unit": unit, "peak_kib": peak_kib}
+    peak = f"{peak_kib:12.1f} KiB" if peak_kib is not None else ""
+    print(f"{name:<36} {seconds * 1000:10.2f} ms {results[name]['throughput']:14.0f} {unit}/s {peak}", flush=True)
+
+
+def bench_imports(results: Results, directory: str, args) -> int:
+    # Cold imports in fresh interpreters, as reported by python -X importtime,
+    # and the wall time of `main.py --help`. Run from an empty directory so
+    # nothing is logged into the checkout. Returns how many are over budget.
+    # The checkout goes first on PYTHONPATH, keeping any entries the
+    # dependencies are installed through.
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH")))))
+    over = 0
+    for module, budget in IMPORT_BUDGETS.items():
+        times = []
+        for _ in range(args.rounds):
+            stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=directory, env=env, capture_output=True, text=True, check=True).stderr
+            line = next(line for line in reversed(stderr.splitlines()) if line.rstrip().endswith(f"| {module}"))
+            times.append(int(line.split("|")[1]) / 1e6)
+        record(results, f"import/{module}", statistics.median(times), 1, "imports")
+        if results[f"import/{module}"]["seconds"] > budget:
+            over += 1
+            print(f"{'':<36} over the {budget * 1000:.0f} ms budget")
+
+    help_command = [sys.executable, os.path.join(ROOT, "main.py"), "--help"]
+    measure(results, "cli/main --help", lambda: subprocess.run(help_command, cwd=directory, env=env, capture_output=True, check=True), 1, "runs", args.rounds, False)
+    return over
+
+
+def bench_pairs(results: Results, directory: str, args) -> None:
+    parser = SubtitleParser()
+    merger = SubtitleMerger(SubtitleAligner(mode=args.mode, tolerance=args.tolerance))
+
+    for count in args.cues:
+        base_path, merge_path = generate_pair(directory, count, offset_ms=args.offset, scale=args.scale, missing=args.missing, seed=args.seed)
+        measure(results, f"parse_srt_file/{count}", lambda: parser.parse_srt_file(base_path), count, "cues", args.rounds, args.memory)
+
+        base = parser.parse_srt_file(base_path)
+        other = parser.parse_srt_file(merge_path)
+        measure(results, f"merge/{count}", lambda: merger.merge(base, other), count, "cues", args.rounds, args.memory)
+
+        saved = Subtitle(file_path="", format="srt")
+        saved.track = base.track
+        out_path = os.path.join(directory, f"saved{count}.srt")
+        measure(results, f"save/{count}", lambda: saved.save(out_path), count, "cues", args.rounds, args.memory)
+
+
+def bench_library(results: Results, root: str, cache_dir: str, args) -> Library:
+    started = time.perf_counter()
+    files = generate_library(root, args.shows, args.seasons, args.episodes, args.movies, seed=args.seed)
+    print(f"Generated {files} files in {time.perf_counter() - started:.1f}s", flush=True)
+
+    parser = SubtitleParser()
+    items = args.shows * args.seasons * args.episodes + args.movies
+
+    def scan(index: Optional[ScanIndex] = None) -> Library:
+        library = Library(movies=[], tv_shows=[])
+        FileParser(library, parser, index=index).parse(root)
+        return library
+
+    # The API benchmarks need the library even when the scans are skipped.
+    if "library" not in args.skip:
+        measure(results, "FileParser.parse/full", scan, items, "items", args.rounds, args.memory)
+
+        index = ScanIndex(cache_dir)
+        scan(index)
+        measure(results, "FileParser.parse/indexed", lambda: scan(index), items, "items", args.rounds, args.memory)
+    return scan()
+
+
+def bench_api(results: Results, root: str, library: Library, args) -> None:
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError:
+        print("Skipping API benchmarks: fastapi (and httpx) are not installed")
+        return
+
+    os.environ["MEEDYA_LIBRARY_DIR"] = root
+    import api
+
+    # Without a `with` block the client never runs the lifespan, so no
+    # background scan competes with the requests.
+    api.store.library = library
+    client = TestClient(api.api)
+
+    show = library.tv_shows[0]
+    season = show.seasons[0]
+    episode = season.episodes[0]
+    endpoints = {
+        "tvshows": "/tvshows?limit=100",
+        "seasons": f"/tvshows/{show.name}/seasons",
+        "episodes": f"/tvshows/{show.name}/seasons/{season.name}/episodes?limit=100",
+        "episode_code": f"/tvshows/{show.name}/episodes/S01E01",
+        "movies": "/movies?limit=100",
+        "episode_subtitles": f"/episodes/{episode.name}/subtitles",
+    }
+
+    def get(path: str, cached: bool = True) -> None:
+        if not cached:
+            api.response_cache.clear()
+        response = client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {path} returned {response.status_code}")
+
+    for name, path in endpoints.items():
+        measure(results, f"api/{name}", lambda: [get(path) for _ in range(args.requests)], args.requests, "req", args.rounds, args.memory)
+    measure(results, "api/tvshows_uncached", lambda: [get(endpoints["tvshows"], cached=False) for _ in range(args.requests)], args.requests, "req", args.rounds, args.memory)
+
+
+def compare(results: Results, baseline_path: str, threshold: float) -> int:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+
+    print(f"\nAgainst {baseline_path} (regression if more than {threshold:.0%} slower):")
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<36} {'(new)':>10}")
+            continue
+        change = result["seconds"] / max(baseline[name]["seconds"], 1e-9) - 1
+        flag = "REGRESSION" if change > threshold else ""
+        regressions += bool(flag)
+        print(f"{name:<36} {change:+10.1%} {flag}")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark parsing, merging, saving, library scans and the API on synthetic data")
+    arg_parser.add_argument("--cues", type=int, nargs="+", default=[1000, 10000, 100000], help="cue counts of the generated SRT pairs")
+    arg_parser.add_argument("--offset", type=int, default=1500, help="offset of the partner track in ms")
+    arg_parser.add_argument("--scale", type=float, default=25 / 23.976, help="framerate drift of the partner track")
+    arg_parser.add_argument("--missing", type=float, default=0.05, help="fraction of cues missing from the partner track")
+    arg_parser.add_argument("--mode", choices=[mode.value for mode in AlignMode], default=AlignMode.TOLERANCE.value)
+    arg_parser.add_argument("--tolerance", type=float, default=1)
+    arg_parser.add_argument("--shows", type=int, default=1000)
+    arg_parser.add_argument("--seasons", type=int, default=2)
+    arg_parser.add_argument("--episodes", type=int, default=10)
+    arg_parser.add_argument("--movies", type=int, default=200)
+    arg_parser.add_argument("--requests", type=int, default=200, help="requests per API endpoint and round")
+    arg_parser.add_argument("--rounds", type=int, default=3)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--skip", choices=["imports", "pairs", "library", "api"], nargs="*", default=[])
+    arg_parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the traced run used for peak memory")
+    arg_parser.add_argument("--baseline", help="compare against results saved with --save-baseline")
+    arg_parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    arg_parser.add_argument("--threshold", type=float, default=0.15, help="slowdown that counts as a regression")
+    arg_parser.add_argument("--keep", action="store_true", help="keep the generated files")
+    args = arg_parser.parse_args()
+
+    # The services log every merge at INFO, which would dominate the timings.
+    logger.setLevel(logging.WARNING)
+
+    results: Results = {}
+    over_budget = 0
+    workdir = tempfile.mkdtemp(prefix="meedya-bench-")
+    try:
+        if "imports" not in args.skip:
+            over_budget = bench_imports(results, workdir, args)
+
+        if "pairs" not in args.skip:
+            pairs_dir = os.path.join(workdir, "pairs")
+            os.makedirs(pairs_dir)
+            bench_pairs(results, pairs_dir, args)
+
+        if {"library", "api"} - set(args.skip):
+            root = os.path.join(workdir, "library")
+            library = bench_library(results, root, os.path.join(workdir, "cache"), args)
+            if "api" not in args.skip:
+                bench_api(results, root, library, args)
+    finally:
+        if args.keep:
+            print(f"Generated files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # ru_maxrss is in KiB on Linux.
+    print(f"\nPeak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version, "machine": platform.platform(), "args": vars(args), "results": results}, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+
+    regressions = compare(results, args.baseline, args.threshold) if args.baseline else 0
+    if regressions or over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
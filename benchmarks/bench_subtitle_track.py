@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.subtitle import SubtitleEntry
+from services.subtitle_parser import SubtitleParser
+from utils.timestamp import format_timing
+
+DEFAULT_SRT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "combined_subtitles.srt")
+
+
+def measure(label, build, rounds):
+    tracemalloc.start()
+    result = build()
+    resident = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        build()
+    elapsed = (time.perf_counter() - started) / rounds
+
+    print(f"{label:<24} {elapsed * 1000:9.2f} ms {resident / 1024:10.1f} KiB")
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Compare SubtitleTrack with a list of SubtitleEntry models")
+    arg_parser.add_argument("srt", nargs="?", default=DEFAULT_SRT)
+    arg_parser.add_argument("--repeat", type=int, default=3, help="concatenate the file this many times")
+    arg_parser.add_argument("--rounds", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    with open(args.srt, encoding="utf-8") as f:
+        body = f.read().strip() + "\n\n"
+
+    parser = SubtitleParser()
+    with tempfile.NamedTemporaryFile("w", suffix=".srt", encoding="utf-8", delete=False) as f:
+        f.write(body * args.repeat)
+        path = f.name
+
+    try:
+        track = measure("SubtitleTrack", lambda: parser.parse_track(path), args.rounds)
+        # One model per cue straight from the parse, as the entry list was
+        # built before tracks, rather than converted from a finished track.
+        measure("List[SubtitleEntry]", lambda: [
+            SubtitleEntry(index=index, timestamp=format_timing(start, end), text=text)
+            for index, start, end, text in parser.iter_cues(path)
+        ], args.rounds)
+        print(f"{len(track)} cues")
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import os
+import random
+from typing import List, Tuple
+
+from utils.timestamp import format_timing
+
+WORDS = (
+    "what", "are", "you", "doing", "here", "we", "need", "to", "talk", "about", "the", "patient",
+    "it's", "not", "lupus", "he", "is", "lying", "everybody", "lies", "run", "an", "MRI", "now",
+)
+CJK = "我们需要谈谈这个病人不是狼疮他在说谎每个人都会撒谎现在做核磁共振"
+
+# (start_ms, end_ms, text)
+SyntheticCue = Tuple[int, int, str]
+
+
+def generate_cues(count: int, seed: int = 0) -> List[SyntheticCue]:
+    rng = random.Random(seed)
+    cues = []
+    t = rng.randint(1000, 30_000)
+    for _ in range(count):
+        duration = rng.randint(700, 5000)
+        words = rng.randint(2, 12)
+        line = " ".join(rng.choice(WORDS) for _ in range(words))
+        text = line if rng.random() < 0.7 else f"{line}\n{' '.join(rng.choice(WORDS) for _ in range(words))}"
+        cues.append((t, t + duration, text))
+        t += duration + rng.randint(40, 4000)
+    return cues
+
+
+def partner_cues(cues: List[SyntheticCue], offset_ms: int = 0, scale: float = 1.0, missing: float = 0.0, jitter_ms: int = 0, seed: int = 0) -> List[SyntheticCue]:
+    # The same dialogue as another release would have it: shifted by
+    # offset_ms, running at a different framerate (its times are the base
+    # times divided by scale), with a fraction of cues dropped and a little
+    # jitter on each timestamp.
+    rng = random.Random(seed + 1)
+    partner = []
+    for start, end, text in cues:
+        if rng.random() < missing:
+            continue
+        new_start = int((start - offset_ms) / scale) + rng.randint(-jitter_ms, jitter_ms)
+        new_end = int((end - offset_ms) / scale) + rng.randint(-jitter_ms, jitter_ms)
+        if new_end <= new_start:
+            new_end = new_start + 1
+        length = max(2, len(text) // 3)
+        partner.append((new_start, new_end, "".join(rng.choice(CJK) for _ in range(length))))
+    # Negative offsets can push the first cues before zero; drop those.
+    return [cue for cue in partner if cue[0] >= 0]
+
+
+def srt_text(cues: List[SyntheticCue]) -> str:
+    return "".join(f"{i}\n{format_timing(start, end)}\n{text}\n\n" for i, (start, end, text) in enumerate(cues, 1))
+
+
+def write_srt(path: str, cues: List[SyntheticCue], newline: str = "\n") -> None:
+    with open(path, "w", encoding="utf-8", newline=newline) as f:
+        f.write(srt_text(cues))
+
+
+def generate_pair(directory: str, count: int, offset_ms: int = 1500, scale: float = 25 / 23.976, missing: float = 0.05, seed: int = 0) -> Tuple[str, str]:
+    cues = generate_cues(count, seed)
+    base_path = os.path.join(directory, f"pair{count}.en.srt")
+    merge_path = os.path.join(directory, f"pair{count}.zh.srt")
+    write_srt(base_path, cues)
+    # The original files in the library use CRLF, so the partner does too.
+    write_srt(merge_path, partner_cues(cues, offset_ms, scale, missing, jitter_ms=40, seed=seed), newline="\r\n")
+    return base_path, merge_path
+
+
+def generate_library(root: str, shows: int, seasons: int, episodes: int, movies: int, cues: int = 20, seed: int = 0) -> int:
+    # A TV folder as FileParser expects it: show/season/episode files with an
+    # English and a Chinese subtitle each, plus movie folders. All subtitles
+    # share one small cue list so generating thousands of them stays cheap.
+    # Returns the number of files written.
+    base_cues = generate_cues(cues, seed)
+    en = srt_text(base_cues)
+    zh = srt_text(partner_cues(base_cues, seed=seed))
+    files = 0
+
+    for show in range(1, shows + 1):
+        show_name = f"Show {show:05d}"
+        for season in range(1, seasons + 1):
+            season_dir = os.path.join(root, show_name, f"Season {season}")
+            os.makedirs(season_dir)
+            for episode in range(1, episodes + 1):
+                stem = os.path.join(season_dir, f"{show_name} S{season:02d}E{episode:02d}")
+                files += _write_media(stem, en, zh)
+
+    for movie in range(1, movies + 1):
+        movie_dir = os.path.join(root, f"Movie {movie:05d} (2000)")
+        os.makedirs(movie_dir)
+        files += _write_media(os.path.join(movie_dir, f"Movie {movie:05d} (2000)"), en, zh)
+
+    return files
+
+
+def _write_media(stem: str, en: str, zh: str) -> int:
+    open(f"{stem}.mkv", "wb").close()
+    with open(f"{stem}.en.srt", "w", encoding="utf-8") as f:
+        f.write(en)
+    with open(f"{stem}.zh.srt", "w", encoding="utf-8") as f:
+        f.write(zh)
+    return 3
@@ -1,42 +1,83 @@
+import argparse
 
-from models.media_item import Library
-from services.subtitle_merger import SubtitleMerger
-from services.subtitle_parser import SubtitleParser
-from services.file_parser import FileParser
-
-from pprint import pprint
+from services.subtitle_aligner import AlignMode
 
 
 def main():
-    library=Library(movies=[],tv_shows=[])
-    parser = SubtitleParser()
-    file_parser= FileParser(library,parser)
-
-    file_parser.parse(r'/mnt/f/TV')
-
-
-    subtitle_merger = SubtitleMerger()
-
-    movies=library.movies
-
+    arg_parser = argparse.ArgumentParser(description="Merge subtitle pairs across the media library")
+    arg_parser.add_argument("directory", nargs="?", default=r'/mnt/f/TV')
+    arg_parser.add_argument("--full-rebuild", action="store_true", help="ignore the scan index and rescan everything")
+    arg_parser.add_argument("--jobs", type=int, default=None, help="merge processes (default: one per core)")
+    arg_parser.add_argument("--force", action="store_true", help="remerge even if the combined file is up to date")
+    arg_parser.add_argument("--no-merge-cache", action="store_true", help="decide what to remerge from file times instead of content hashes")
+    arg_parser.add_argument("--mode", choices=[mode.value for mode in AlignMode], default=AlignMode.TOLERANCE.value)
+    arg_parser.add_argument("--format", choices=["srt", "vtt"], default="srt", help="output format of the combined files")
+    arg_parser.add_argument("--languages", help="comma-separated languages to merge, base first (default: every language, in file order)")
+    arg_parser.add_argument("--tolerance", type=float, default=1, help="match tolerance in seconds")
+    arg_parser.add_argument("--watch", action="store_true", help="keep running and merge new subtitle pairs as they appear")
+    arg_parser.add_argument("--poll", action="store_true", help="watch by polling instead of inotify")
+    arg_parser.add_argument("--profile", metavar="DIR", help="profile the scan and merge (main and worker processes) and write the reports to DIR")
+    arg_parser.add_argument("--trace-memory", action="store_true", help="with --profile, also report the top allocation sites")
+    repair_args = arg_parser.add_argument_group("timing repair", "fix the timings of the combined files as they are written (needs numpy)")
+    repair_args.add_argument("--repair", action="store_true", help="repair overlaps, short cues and repeated lines (with --no-merge-cache, add --force to redo files merged before)")
+    repair_args.add_argument("--shift", type=int, metavar="MS", help="move every cue by this many ms")
+    repair_args.add_argument("--scale", type=float, help="multiply every time by this, e.g. 1.0427 (25/23.976) for a framerate change")
+    repair_args.add_argument("--overlap", choices=["trim", "merge", "keep"], help="how to fix overlapping cues (default: trim)")
+    repair_args.add_argument("--min-duration", type=int, metavar="MS", help="lengthen cues shorter than this many ms (default: 500)")
+    repair_args.add_argument("--min-gap", type=int, metavar="MS", help="keep this many ms between cues (default: 40)")
+    repair_args.add_argument("--no-compact", dest="compact", action="store_false", help="keep empty cues and repeats of the same line")
+    repair_args.add_argument("--no-dedupe", dest="dedupe", action="store_false", help="repeat a second-language line under every base cue it matched")
+    args = arg_parser.parse_args()
+
+    # Imported after the arguments are parsed, so --help and usage errors do
+    # not pay for pydantic and the services.
+    from models.media_item import Library
+    from services.batch_merger import BatchMerger
+    from services.file_parser import FileParser
+    from services.merge_cache import MergeCache
+    from services.scan_index import ScanIndex
+    from services.subtitle_cache import subtitle_cache
+    from utils.instrumentation import counters
+    from utils.logger import enable_queue_logging, logger
+    from utils.profiling import log_breakdown, profiled
+
+    enable_queue_logging()
 
-    tv_shows=library.tv_shows
-    
-    for tv_show in tv_shows:
-        seasons=tv_show.seasons
-        for season in seasons:
-            episodes=season.episodes
-            for episode in episodes:
-                
-                # We have two subtitles
-                if(len(episode.subtitles)==2):
-                    print('we have two')
-                    print(episode)
-                    subtitle_merger.merge(episode.subtitles[0], episode.subtitles[1])
-
-
-
-
-
-
-main()
+    library=Library(movies=[],tv_shows=[])
+    parser = subtitle_cache.parser
+    file_parser= FileParser(library,parser,index=ScanIndex())
+
+    with profiled(args.profile, "main", args.trace_memory):
+        file_parser.parse(args.directory, full_rebuild=args.full_rebuild)
+
+        merge_cache = None if args.no_merge_cache else MergeCache()
+        languages = args.languages.split(",") if args.languages else None
+        repair = None
+        if args.repair:
+            from services.timing_repair import RepairOptions
+            given = {"shift_ms": args.shift, "scale": args.scale, "overlap": args.overlap, "min_duration_ms": args.min_duration, "min_gap_ms": args.min_gap}
+            repair = RepairOptions(compact=args.compact, dedupe=args.dedupe, **{name: value for name, value in given.items() if value is not None})
+        batch_merger = BatchMerger(max_workers=args.jobs, mode=args.mode, tolerance=args.tolerance, force=args.force, format=args.format, cache=merge_cache, languages=languages, profile_dir=args.profile, trace_memory=args.trace_memory, repair=repair)
+        jobs = batch_merger.build_jobs(library)
+        summary = batch_merger.run(jobs)
+
+    counters.log_summary(logger)
+    if args.profile:
+        log_breakdown(logger, counters.per_file(), args.directory)
+        logger.info(f"Profiles written to {args.profile}")
+    print(summary)
+
+    if args.watch:
+        from services.library_store import LibraryStore
+        from services.library_watcher import LibraryWatcher
+        store = LibraryStore(args.directory, parser, index=file_parser.index)
+        store.library = library
+        watcher = LibraryWatcher(store, use_inotify=not args.poll, auto_merge=True, batch_merger=batch_merger)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
-from pydantic import BaseModel
-from typing import List, Optional
+import itertools
+from pydantic import BaseModel, PrivateAttr
+from typing import Dict, List, Optional, Tuple
 from models.subtitle import Subtitle
+from utils.release_name import episode_code
+
+# Shared by every Library, so a generation number never repeats even when one
+# library snapshot replaces another.
+_generations = itertools.count(1)
 
 
 class MediaItem(BaseModel):
@@ -14,26 +20,144 @@ class Movie(MediaItem):
 class Episode(MediaItem):
     pass
 
+# Seasons and shows keep a back-reference to whatever they were added to, so
+# adding an episode or season anywhere in the tree also updates the owning
+# Library's indexes.
+
 class Season(BaseModel):
     name: str
     episodes: List[Episode] = []
 
+    _show: Optional["TVShow"] = PrivateAttr(default=None)
+
     def add_episode(self, episode: Episode):
         self.episodes.append(episode)
+        library = self._show._library if self._show is not None else None
+        if library is not None:
+            library._index_episode(self._show, episode)
+
+    def remove_episode(self, episode: Episode):
+        self.episodes = [e for e in self.episodes if e is not episode]
+        library = self._show._library if self._show is not None else None
+        if library is not None:
+            library._unindex_episode(self._show, episode)
 
 class TVShow(BaseModel):
     name: str
     seasons: List[Season] = []
 
+    _library: Optional["Library"] = PrivateAttr(default=None)
+
     def add_season(self, season: Season):
         self.seasons.append(season)
+        season._show = self
+        if self._library is not None:
+            self._library._index_season(self, season)
 
 class Library(BaseModel):
     movies: List[Movie] = []
     tv_shows: List[TVShow] = []
 
+    _tv_shows_by_name: Dict[str, TVShow] = PrivateAttr(default_factory=dict)
+    _seasons_by_name: Dict[Tuple[str, str], Season] = PrivateAttr(default_factory=dict)
+    _episodes_by_name: Dict[str, List[Episode]] = PrivateAttr(default_factory=dict)
+    _episodes_by_code: Dict[Tuple[str, str], List[Episode]] = PrivateAttr(default_factory=dict)
+    _movies_by_name: Dict[str, Movie] = PrivateAttr(default_factory=dict)
+    _subtitles_by_id: Dict[str, Subtitle] = PrivateAttr(default_factory=dict)
+    _subtitles_generation: Optional[int] = PrivateAttr(default=None)
+    _generation: int = PrivateAttr(default_factory=lambda: next(_generations))
+
+    # Bumped on every change so caches built from the library can tell when
+    # they are stale.
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def touch(self) -> None:
+        self._generation = next(_generations)
+
+    def model_post_init(self, __context) -> None:
+        for movie in self.movies:
+            self._movies_by_name.setdefault(movie.name, movie)
+        for tv_show in self.tv_shows:
+            self._index_tv_show(tv_show)
+
     def add_movie(self, movie: Movie):
         self.movies.append(movie)
+        self._movies_by_name.setdefault(movie.name, movie)
+        self.touch()
 
     def add_tv_show(self, tv_show: TVShow):
         self.tv_shows.append(tv_show)
+        self._index_tv_show(tv_show)
+
+    def get_movie(self, name: str) -> Optional[Movie]:
+        return self._movies_by_name.get(name)
+
+    def get_tv_show(self, name: str) -> Optional[TVShow]:
+        return self._tv_shows_by_name.get(name)
+
+    def get_season(self, tv_show_name: str, season_name: str) -> Optional[Season]:
+        return self._seasons_by_name.get((tv_show_name, season_name))
+
+    def get_episode(self, name: str) -> Optional[Episode]:
+        episodes = self._episodes_by_name.get(name)
+        return episodes[0] if episodes else None
+
+    def get_subtitle(self, subtitle_id: str) -> Optional[Subtitle]:
+        # Subtitle lists are also replaced in place (e.g. by the watcher), so
+        # this index is rebuilt on the first lookup after any change instead
+        # of being maintained.
+        if self._subtitles_generation != self._generation:
+            subtitles: Dict[str, Subtitle] = {}
+            items = [episode for tv_show in self.tv_shows for season in tv_show.seasons for episode in season.episodes] + self.movies
+            for item in items:
+                for subtitle in item.subtitles:
+                    subtitles.setdefault(subtitle.id, subtitle)
+            self._subtitles_by_id = subtitles
+            self._subtitles_generation = self._generation
+        return self._subtitles_by_id.get(subtitle_id)
+
+    def find_episodes(self, tv_show_name: str, code: str) -> List[Episode]:
+        normalized = episode_code(code)
+        if normalized is None:
+            return []
+        return list(self._episodes_by_code.get((tv_show_name, normalized), []))
+
+    # Lookups return the first item added under a name, which is what the
+    # linear scans they replace returned.
+
+    def _index_tv_show(self, tv_show: TVShow) -> None:
+        self.touch()
+        tv_show._library = self
+        self._tv_shows_by_name.setdefault(tv_show.name, tv_show)
+        for season in tv_show.seasons:
+            season._show = tv_show
+            self._index_season(tv_show, season)
+
+    def _index_season(self, tv_show: TVShow, season: Season) -> None:
+        self.touch()
+        self._seasons_by_name.setdefault((tv_show.name, season.name), season)
+        for episode in season.episodes:
+            self._index_episode(tv_show, episode)
+
+    def _index_episode(self, tv_show: TVShow, episode: Episode) -> None:
+        self.touch()
+        self._episodes_by_name.setdefault(episode.name, []).append(episode)
+        code = episode_code(episode.name)
+        if code is not None:
+            self._episodes_by_code.setdefault((tv_show.name, code), []).append(episode)
+
+    def _unindex_episode(self, tv_show: TVShow, episode: Episode) -> None:
+        self.touch()
+        self.__discard(self._episodes_by_name, episode.name, episode)
+        code = episode_code(episode.name)
+        if code is not None:
+            self.__discard(self._episodes_by_code, (tv_show.name, code), episode)
+
+    def __discard(self, index: dict, key, episode: Episode) -> None:
+        remaining = [e for e in index.get(key, []) if e is not episode]
+        if remaining:
+            index[key] = remaining
+        else:
+            index.pop(key, None)
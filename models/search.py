@@ -0,0 +1,17 @@
+from pydantic import BaseModel
+from typing import Optional
+
+# One cue matching a search, with where it was found. show and season are
+# unset for movies.
+
+class SearchHit(BaseModel):
+    name: str
+    show: Optional[str] = None
+    season: Optional[str] = None
+    file_path: str
+    language: Optional[str] = None
+    cue: int
+    start_ms: int
+    end_ms: int
+    text: str
+    score: float
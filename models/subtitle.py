@@ -1,5 +1,8 @@
+import hashlib
 from typing import List, Dict, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, computed_field
+from models.subtitle_track import SubtitleTrack
+from utils.timestamp import format_timing, parse_timing
 
 class SubtitleEntry(BaseModel):
     index: int
@@ -7,29 +10,112 @@ class SubtitleEntry(BaseModel):
     text: str
 
 
-class Subtitle(BaseModel):
+class CueEntry(BaseModel):
+    index: int
+    start_ms: int
+    end_ms: int
+    text: str
+
+
+class SubtitleDetail(BaseModel):
     file_path: str
     format: str
     language: Optional[str] = None
     entries: List[SubtitleEntry] = Field(default_factory=list)
 
+
+class Subtitle(BaseModel):
+    file_path: str
+    format: str
+    language: Optional[str] = None
+    size: Optional[int] = None
+    entry_count: Optional[int] = None
+
+    # A track assigned directly (e.g. a freshly merged subtitle) lives on the
+    # object. Otherwise the subtitle is metadata-only and its track is read
+    # from file_path on first access and held in the shared subtitle cache.
+    _track: Optional[SubtitleTrack] = PrivateAttr(default=None)
+
+    # Stable across scans and restarts, for addressing a subtitle in URLs.
+    @computed_field
+    @property
+    def id(self) -> str:
+        return hashlib.blake2b(self.file_path.encode("utf-8"), digest_size=8).hexdigest()
+
+    @property
+    def track(self) -> SubtitleTrack:
+        if self._track is not None:
+            return self._track
+
+        from services.subtitle_cache import subtitle_cache
+        track = subtitle_cache.get(self)
+        self.entry_count = len(track)
+        return track
+
+    @track.setter
+    def track(self, track: SubtitleTrack) -> None:
+        self._track = track
+        self.entry_count = len(track)
+
+    # SubtitleEntry objects are only built here, for the API and callers that
+    # still want the pydantic view; everything else works on the track.
+    @property
+    def entries(self) -> List[SubtitleEntry]:
+        return [
+            SubtitleEntry(index=index, timestamp=format_timing(start, end), text=text)
+            for index, start, end, text in self.track.cues()
+        ]
+
+    @entries.setter
+    def entries(self, entries: List[SubtitleEntry]) -> None:
+        track = SubtitleTrack()
+        for entry in entries:
+            timing = parse_timing(entry.timestamp)
+            if timing is not None:
+                track.append(entry.index, timing[0], timing[1], entry.text)
+        self.track = track
+
+    @property
+    def is_loaded(self) -> bool:
+        if self._track is not None:
+            return True
+
+        from services.subtitle_cache import subtitle_cache
+        return subtitle_cache.contains(self)
+
     def add_entry(self, index: int, timestamp: str, text: str):
-        entry = SubtitleEntry(index=index, timestamp=timestamp, text=text)
-        self.entries.append(entry)
+        timing = parse_timing(timestamp)
+        if timing is None:
+            raise ValueError(f"Invalid timestamp: {timestamp!r}")
+        if self._track is None:
+            # Copy the cues from the file before the track is set, since the
+            # track property would then return the new track. A subtitle with
+            # no file yet starts empty.
+            track = SubtitleTrack()
+            try:
+                track.extend(self.track.cues())
+            except FileNotFoundError:
+                pass
+            self._track = track
+        self._track.append(index, timing[0], timing[1], text)
+        self.entry_count = len(self._track)
 
     def save(self, path: str):
+        from services.subtitle_writer import SubtitleWriter
+        SubtitleWriter.for_path(path).write(path, self.track.cues())
         self.file_path = path
-        with open(self.file_path, 'w', encoding='utf-8') as f:
-            for entry in self.entries:
-                f.write(f"{entry.index}\n")
-                f.write(f"{entry.timestamp}\n")
-                f.write(f"{entry.text}\n\n")
+
+    def detail(self) -> SubtitleDetail:
+        return SubtitleDetail(file_path=self.file_path, format=self.format, language=self.language, entries=self.entries)
 
     def get_entry_count(self) -> int:
-        return len(self.entries)
+        if self.entry_count is None:
+            return len(self.track)
+        return self.entry_count
 
     def __str__(self):
-        return f"Subtitle({self.file_path}, {self.format}, {len(self.entries)} entries)"
+        count = "?" if self.entry_count is None else self.entry_count
+        return f"Subtitle({self.file_path}, {self.format}, {count} entries)"
 
     def __repr__(self):
         return f"Subtitle({self.file_path}, {self.format})"
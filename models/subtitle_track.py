@@ -0,0 +1,61 @@
+import sys
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+Cue = Tuple[int, int, int, str]
+
+
+class SubtitleTrack:
+    # Cues stored column-wise: cue numbers and start/end milliseconds in int32
+    # arrays, and all cue text in one string sliced by an offsets array. Text
+    # appended while building is joined into the buffer on first read.
+    __slots__ = ("indexes", "starts", "ends", "_offsets", "_buffer", "_pending")
+
+    def __init__(self) -> None:
+        self.indexes = array("i")
+        self.starts = array("i")
+        self.ends = array("i")
+        self._offsets = array("q", [0])
+        self._buffer = ""
+        self._pending: List[str] = []
+
+    def append(self, index: int, start: int, end: int, text: str) -> None:
+        self.indexes.append(index)
+        self.starts.append(start)
+        self.ends.append(end)
+        self._offsets.append(self._offsets[-1] + len(text))
+        self._pending.append(text)
+
+    def extend(self, cues: Iterable[Cue]) -> None:
+        for index, start, end, text in cues:
+            self.append(index, start, end, text)
+
+    def text(self, i: int) -> str:
+        buffer = self.__buffer()
+        return buffer[self._offsets[i]:self._offsets[i + 1]]
+
+    def texts(self) -> Iterator[str]:
+        buffer = self.__buffer()
+        offsets = self._offsets
+        for i in range(len(self.indexes)):
+            yield buffer[offsets[i]:offsets[i + 1]]
+
+    def cues(self) -> Iterator[Cue]:
+        return zip(self.indexes, self.starts, self.ends, self.texts())
+
+    def spans(self) -> List[Optional[Tuple[int, int]]]:
+        return list(zip(self.starts, self.ends))
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.indexes, self.starts, self.ends, self._offsets)
+        return sum(a.buffer_info()[1] * a.itemsize for a in arrays) + sys.getsizeof(self.__buffer())
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+    def __buffer(self) -> str:
+        if self._pending:
+            self._buffer += "".join(self._pending)
+            self._pending = []
+        return self._buffer
@@ -0,0 +1,38 @@
+from pydantic import BaseModel
+from typing import List
+from models.media_item import Episode, Movie, Season, TVShow
+from models.subtitle import Subtitle
+
+# Listing views of the library. Subtitles appear as metadata only; cues are
+# served by the subtitle endpoints.
+
+class TVShowSummary(BaseModel):
+    name: str
+    season_count: int
+
+    @classmethod
+    def of(cls, tv_show: TVShow) -> "TVShowSummary":
+        return cls(name=tv_show.name, season_count=len(tv_show.seasons))
+
+class SeasonSummary(BaseModel):
+    name: str
+    episode_count: int
+
+    @classmethod
+    def of(cls, season: Season) -> "SeasonSummary":
+        return cls(name=season.name, episode_count=len(season.episodes))
+
+class MediaItemSummary(BaseModel):
+    name: str
+    path: str
+    subtitles: List[Subtitle]
+
+class EpisodeSummary(MediaItemSummary):
+    @classmethod
+    def of(cls, episode: Episode) -> "EpisodeSummary":
+        return cls(name=episode.name, path=episode.path, subtitles=episode.subtitles)
+
+class MovieSummary(MediaItemSummary):
+    @classmethod
+    def of(cls, movie: Movie) -> "MovieSummary":
+        return cls(name=movie.name, path=movie.path, subtitles=movie.subtitles)
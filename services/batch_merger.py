@@ -0,0 +1,268 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from models.media_item import Library
+from models.subtitle import Subtitle
+from services.merge_cache import MergeCache, MergeCacheStats
+from services.subtitle_aligner import AlignMode, SubtitleAligner
+from services.subtitle_merger import SubtitleMerger
+from services.subtitle_cache import subtitle_cache
+from services.subtitle_writer import SubtitleWriter
+from utils.instrumentation import counters
+from utils.logger import logger
+from utils.metrics import stage_seconds
+
+if TYPE_CHECKING:
+    from services.timing_repair import RepairOptions
+
+COMBINED_TAG = "_combined"
+
+
+class MergeJob(NamedTuple):
+    base_path: str
+    merge_paths: Tuple[str, ...]
+    output_path: str
+
+    @property
+    def input_paths(self) -> Tuple[str, ...]:
+        return (self.base_path,) + self.merge_paths
+
+
+class MergeResult(NamedTuple):
+    job: MergeJob
+    cues: int
+    matches: int
+    misses: int
+    # Seconds spent per stage (parse, align, write), since metrics recorded in
+    # a worker process never reach the parent's registry.
+    seconds: Dict[str, float]
+
+
+class BatchSummary(NamedTuple):
+    merged: int
+    skipped: int
+    failed: int
+    cues: int
+    seconds: float
+    cache: Optional[MergeCacheStats] = None
+
+    def __str__(self) -> str:
+        seconds = max(self.seconds, 1e-9)
+        summary = (
+            f"Merged {self.merged} files ({self.skipped} up to date, {self.failed} failed) "
+            f"and {self.cues} cues in {self.seconds:.2f}s: "
+            f"{self.merged / seconds:.1f} files/s, {self.cues / seconds:.0f} cues/s"
+        )
+        return f"{summary}; {self.cache}" if self.cache is not None else summary
+
+
+# Each worker process builds its own merger and writer once, via the pool
+# initializer, instead of pickling them with every job.
+_worker_merger: Optional[SubtitleMerger] = None
+_worker_writer: Optional[SubtitleWriter] = None
+
+
+def _init_worker(mode: AlignMode, tolerance: float, format: str, profile_dir: Optional[str] = None, trace_memory: bool = False, repair: Optional["RepairOptions"] = None) -> None:
+    global _worker_merger, _worker_writer
+    if profile_dir is not None:
+        from utils.profiling import profile_worker
+        profile_worker(profile_dir, trace_memory)
+    _worker_merger = _build_merger(mode, tolerance, repair)
+    _worker_writer = SubtitleWriter(format)
+
+
+def _build_merger(mode: AlignMode, tolerance: float, repair: Optional["RepairOptions"]) -> SubtitleMerger:
+    # Timing repair needs numpy, so it is only imported when asked for.
+    timing_repair = None
+    if repair is not None:
+        from services.timing_repair import TimingRepair
+        timing_repair = TimingRepair(repair)
+    return SubtitleMerger(SubtitleAligner(mode=mode, tolerance=tolerance), timing_repair)
+
+
+def _run_job(job: MergeJob) -> MergeResult:
+    return _merge_job(job, _worker_merger, _worker_writer)
+
+
+def _merge_job(job: MergeJob, merger: SubtitleMerger, writer: SubtitleWriter) -> MergeResult:
+    started = time.perf_counter()
+    # Workers are forked with the parent's parse cache, so a file the parent
+    # already parsed (for the search index, say) is not read again; files
+    # parsed here are not kept, as no other job needs them.
+    base_track = subtitle_cache.get_file(job.base_path, store=False)
+    merge_tracks = [subtitle_cache.get_file(path, store=False) for path in job.merge_paths]
+    parsed = time.perf_counter()
+    merged_cues = merger.iter_merged_all(base_track, merge_tracks, job.base_path)
+    aligned = time.perf_counter()
+    # Merged cues stream straight to the output; the writer replaces it
+    # atomically, so an interrupted run never leaves a truncated file behind.
+    # Timing repair, when on, has already run and is counted under align.
+    cues = writer.write(job.output_path, merged_cues)
+    written = time.perf_counter()
+
+    totals = counters.per_file().get(job.base_path, {})
+    seconds = {"parse": parsed - started, "align": aligned - parsed, "write": written - aligned}
+    return MergeResult(job, cues, totals.get("matches", 0), totals.get("misses", 0), seconds)
+
+
+class BatchMerger:
+    def __init__(self, max_workers: Optional[int] = None, mode: AlignMode = AlignMode.TOLERANCE, tolerance: float = 1, force: bool = False, format: str = "srt", cache: Optional[MergeCache] = None, languages: Optional[Sequence[str]] = None, profile_dir: Optional[str] = None, trace_memory: bool = False, repair: Optional["RepairOptions"] = None) -> None:
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.mode = AlignMode(mode)
+        self.tolerance = tolerance
+        self.force = force
+        self.format = format
+        self.cache = cache
+        self.languages = [language.lower() for language in languages] if languages else None
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.repair = repair
+        self.merger = _build_merger(self.mode, self.tolerance, self.repair)
+        self.writer = SubtitleWriter(format)
+        self.__cache_loaded = False
+
+    def build_jobs(self, library: Library) -> List[MergeJob]:
+        jobs = []
+        for tv_show in library.tv_shows:
+            for season in tv_show.seasons:
+                for episode in season.episodes:
+                    job = self.build_job(episode.subtitles)
+                    if job is not None:
+                        jobs.append(job)
+                    else:
+                        logger.debug("Episode %s has fewer than 2 usable subtitles, skipping", episode.name)
+        return jobs
+
+    def build_job(self, subtitles: List[Subtitle]) -> Optional[MergeJob]:
+        # Earlier outputs show up in the scan as subtitles of their own.
+        selected = self.select([s for s in subtitles if COMBINED_TAG not in os.path.basename(s.file_path)])
+        if len(selected) < 2:
+            return None
+        base, others = selected[0], tuple(s.file_path for s in selected[1:])
+        return MergeJob(base.file_path, others, self.merger.output_path(base.file_path, self.format))
+
+    def select(self, subtitles: List[Subtitle]) -> List[Subtitle]:
+        # One subtitle per language, base first. Tags are grouped by their
+        # first part, and the plain tag wins over variants ("en" over
+        # "en.sdh"). With a language list, only those languages are used, in
+        # that order, and an entry may name a variant exactly; otherwise all
+        # languages are used in file order.
+        by_language: Dict[str, Subtitle] = {}
+        for subtitle in subtitles:
+            tag = (subtitle.language or "").lower()
+            language = tag.split(".")[0]
+            current = by_language.get(language)
+            if current is None or (tag == language and (current.language or "").lower() != language):
+                by_language[language] = subtitle
+
+        if self.languages is None:
+            return list(by_language.values())
+
+        by_tag = {(s.language or "").lower(): s for s in reversed(subtitles)}
+        selected = []
+        for language in self.languages:
+            subtitle = by_tag.get(language) or by_language.get(language)
+            if subtitle is not None and all(subtitle is not s for s in selected):
+                selected.append(subtitle)
+        return selected
+
+    def is_up_to_date(self, job: MergeJob) -> bool:
+        try:
+            output_mtime = os.stat(job.output_path).st_mtime_ns
+            return all(output_mtime > os.stat(path).st_mtime_ns for path in job.input_paths)
+        except FileNotFoundError:
+            return False
+
+    def merge(self, job: MergeJob) -> bool:
+        # Runs one job in this process, with the same skip rules as run(), for
+        # the watcher: a process pool is not worth starting per episode. True
+        # if the job was merged rather than found up to date.
+        key = None
+        if self.cache is not None:
+            if not self.__cache_loaded:
+                self.cache.load()
+                self.__cache_loaded = True
+            key = self.__cache_key(job)
+            if key is not None and not self.force and self.cache.lookup(key, job.output_path):
+                self.cache.save()
+                return False
+        elif not self.force and self.is_up_to_date(job):
+            return False
+
+        result = _merge_job(job, self.merger, self.writer)
+        if key is not None:
+            self.cache.store(key, job.output_path)
+            self.cache.save()
+        logger.debug("Merged %s (%d cues)", job.output_path, result.cues)
+        return True
+
+    def run(self, jobs: List[MergeJob]) -> BatchSummary:
+        started = time.perf_counter()
+        keys: Dict[MergeJob, Optional[str]] = {}
+        if self.cache is not None:
+            pending, keys = self.__check_cache(jobs)
+        else:
+            pending = [job for job in jobs if self.force or not self.is_up_to_date(job)]
+        skipped = len(jobs) - len(pending)
+        merged = failed = cues = 0
+
+        if pending:
+            workers = min(self.max_workers, len(pending))
+            logger.info(f"Merging {len(pending)} subtitle pairs with {workers} processes ({skipped} up to date)")
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.mode, self.tolerance, self.format, self.profile_dir, self.trace_memory, self.repair)) as pool:
+                futures: Dict = {pool.submit(_run_job, job): job for job in pending}
+                for future in as_completed(futures):
+                    job = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        failed += 1
+                        logger.error(f"Failed to merge {job.base_path} with {', '.join(job.merge_paths)}: {e}")
+                        continue
+                    merged += 1
+                    cues += result.cues
+                    if keys.get(job) is not None:
+                        self.cache.store(keys[job], job.output_path)
+                    for stage, seconds in result.seconds.items():
+                        stage_seconds.observe(seconds, stage=stage)
+                    counters.add(
+                        job.base_path, merges=1, matches=result.matches, misses=result.misses,
+                        **{f"{stage}_ms": round(seconds * 1000) for stage, seconds in result.seconds.items()},
+                    )
+                    logger.debug("Merged %s (%d cues)", job.output_path, result.cues)
+
+        stats = None
+        if self.cache is not None:
+            self.cache.prune()
+            self.cache.save()
+            # A forced run never consults the cache, only refills it.
+            if not self.force:
+                stats = self.cache.stats
+                logger.info(f"Batch {stats}")
+
+        return BatchSummary(merged, skipped, failed, cues, time.perf_counter() - started, stats)
+
+    def __check_cache(self, jobs: List[MergeJob]) -> Tuple[List[MergeJob], Dict[MergeJob, Optional[str]]]:
+        self.cache.load()
+        self.__cache_loaded = True
+        # Hashing is mostly file reads, which threads overlap well.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            keys = dict(zip(jobs, pool.map(self.__cache_key, jobs)))
+
+        pending = []
+        for job in jobs:
+            key = keys[job]
+            if key is None or self.force or not self.cache.lookup(key, job.output_path):
+                pending.append(job)
+        return pending, keys
+
+    def __cache_key(self, job: MergeJob) -> Optional[str]:
+        try:
+            # Repair settings are only part of the key when set, so keys of
+            # plain merges stay as they were.
+            repair = (tuple(self.repair),) if self.repair is not None else ()
+            return self.cache.key(job.input_paths, self.mode.value, self.tolerance, self.format, *repair)
+        except OSError as e:
+            logger.warning(f"Could not hash the inputs of {job.output_path}: {e}")
+            return None
@@ -0,0 +1,151 @@
+import json
+import os
+import zlib
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from models.media_item import Library
+from models.subtitle import Subtitle
+from services.batch_merger import COMBINED_TAG
+from services.subtitle_parser import SubtitleParser
+from utils.logger import logger
+
+# Output is handed to the server in chunks of about this many bytes.
+CHUNK_BYTES = 64 * 1024
+UNITS = ("cue", "episode")
+
+
+class ExportItem(NamedTuple):
+    # An episode or a movie; show and season are unset for movies.
+    show: Optional[str]
+    season: Optional[str]
+    name: str
+    subtitles: List[Subtitle]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CueExporter:
+    # Streams the cues of many subtitles as NDJSON, one cue (or one episode
+    # with all its cues) per line, parsing each file as it is reached, so the
+    # memory used is bounded by one file however large the export is. Every
+    # line carries a cursor; passing the last one received resumes the export
+    # right after that line.
+    def __init__(self, parser: SubtitleParser, chunk_bytes: int = CHUNK_BYTES) -> None:
+        self.parser = parser
+        self.chunk_bytes = chunk_bytes
+
+    def items(self, library: Library, show: Optional[str] = None, season: Optional[str] = None) -> List[ExportItem]:
+        # A snapshot of what to export, taken when the request starts, so a
+        # rescan or the watcher changing the library does not disturb the
+        # stream. Combined files repeat the cues of their inputs and are left
+        # out; items without subtitles have nothing to export.
+        items = []
+        for tv_show in library.tv_shows:
+            if show is not None and tv_show.name != show:
+                continue
+            for tv_season in tv_show.seasons:
+                if season is not None and tv_season.name != season:
+                    continue
+                for episode in tv_season.episodes:
+                    items.append(ExportItem(tv_show.name, tv_season.name, episode.name, self.__exported(episode.subtitles)))
+        if show is None:
+            for movie in library.movies:
+                items.append(ExportItem(None, None, movie.name, self.__exported(movie.subtitles)))
+        return [item for item in items if item.subtitles]
+
+    def resume_point(self, items: List[ExportItem], cursor: Optional[str]) -> Tuple[int, int, int]:
+        # (item, subtitle, cue position) to start from. Checked before the
+        # response starts, so a bad cursor is still a 400 and not a broken
+        # stream.
+        if not cursor:
+            return 0, 0, 0
+        subtitle_id, _, position = cursor.partition(":")
+        if not position.lstrip("-").isdigit():
+            raise InvalidCursor(f"Malformed cursor {cursor!r}")
+        for i, item in enumerate(items):
+            for j, subtitle in enumerate(item.subtitles):
+                if subtitle.id == subtitle_id:
+                    return i, j, int(position) + 1
+        raise InvalidCursor(f"Cursor {cursor!r} does not point into this export")
+
+    def stream(self, items: List[ExportItem], unit: str = "cue", start: Tuple[int, int, int] = (0, 0, 0), compress: bool = False) -> Iterator[bytes]:
+        lines = self.__cue_lines(items, start) if unit == "cue" else self.__episode_lines(items, start)
+        compressor = zlib.compressobj(wbits=31) if compress else None  # gzip framing
+        buffer: List[str] = []
+        size = 0
+
+        for line in lines:
+            buffer.append(line)
+            size += len(line)
+            if size >= self.chunk_bytes:
+                chunk = "".join(buffer).encode("utf-8")
+                buffer.clear()
+                size = 0
+                if compressor is not None:
+                    chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                yield chunk
+
+        chunk = "".join(buffer).encode("utf-8")
+        if compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+
+    def __cue_lines(self, items: List[ExportItem], start: Tuple[int, int, int]) -> Iterator[str]:
+        first_item, first_subtitle, first_position = start
+        dumps = json.JSONEncoder(ensure_ascii=False).encode
+        for i in range(first_item, len(items)):
+            item = items[i]
+            for j in range(first_subtitle if i == first_item else 0, len(item.subtitles)):
+                subtitle = item.subtitles[j]
+                skip = first_position if (i, j) == (first_item, first_subtitle) else 0
+                # The fields shared by every cue of the file are encoded once.
+                prefix = self.__line({
+                    "show": item.show, "season": item.season, "episode": item.name,
+                    "subtitle_id": subtitle.id, "language": subtitle.language,
+                })[:-2]
+                for position, (index, start_ms, end_ms, text) in enumerate(self.__cues(subtitle)):
+                    if position < skip:
+                        continue
+                    if index is None:
+                        yield self.__line({"subtitle_id": subtitle.id, "error": text, "cursor": f"{subtitle.id}:{position}"})
+                        break
+                    yield f'{prefix},"cue":{index},"start_ms":{start_ms},"end_ms":{end_ms},"text":{dumps(text)},"cursor":"{subtitle.id}:{position}"}}\n'
+
+    def __episode_lines(self, items: List[ExportItem], start: Tuple[int, int, int]) -> Iterator[str]:
+        # Episode cursors point at the item's last subtitle, so resuming from
+        # one starts with the next item.
+        first_item = start[0] + 1 if start != (0, 0, 0) else 0
+        for item in items[first_item:]:
+            subtitles = []
+            for subtitle in item.subtitles:
+                entry: Dict = {"id": subtitle.id, "language": subtitle.language, "cues": []}
+                for index, start_ms, end_ms, text in self.__cues(subtitle):
+                    if index is None:
+                        entry["error"] = text
+                        break
+                    entry["cues"].append([index, start_ms, end_ms, text])
+                subtitles.append(entry)
+            yield self.__line({
+                "show": item.show, "season": item.season, "episode": item.name,
+                "subtitles": subtitles, "cursor": f"{item.subtitles[-1].id}:{2 ** 31 - 1}",
+            })
+
+    def __cues(self, subtitle: Subtitle) -> Iterator[Tuple]:
+        # Straight from the parser rather than the subtitle cache, which an
+        # export of the whole library would only flush. A file that cannot be
+        # read ends its cues with an (None, 0, 0, error) marker, since the
+        # response status has long been sent.
+        try:
+            yield from self.parser.iter_cues(subtitle.file_path)
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Export skipped the rest of {subtitle.file_path}: {e}")
+            yield None, 0, 0, str(e)
+
+    def __exported(self, subtitles: List[Subtitle]) -> List[Subtitle]:
+        return [subtitle for subtitle in subtitles if COMBINED_TAG not in os.path.basename(subtitle.file_path)]
+
+    @staticmethod
+    def __line(record: Dict) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
@@ -0,0 +1,266 @@
+import codecs
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from models.subtitle_track import Cue
+from services.scan_index import DEFAULT_CACHE_DIR
+from services.subtitle_cache import subtitle_cache
+from services.subtitle_parser import SubtitleParser
+from utils.logger import logger
+from utils.timestamp import parse_timing
+
+OFFSETS_DIR = "cue_offsets"
+MAGIC = b"MCUE"
+VERSION = 1
+# magic, version, file size, file mtime_ns, cue count, longest cue in ms,
+# whether starts are sorted, encoding; padded to 56 bytes so the int64
+# offsets that follow are aligned.
+HEADER = struct.Struct("<4sIqqiii16s4x")
+
+# BLOCK_RE from the parser, on raw bytes. This only works for encodings where
+# newlines, digits and "-->" are plain ASCII bytes, which rules out UTF-16.
+BLOCK_BYTES_RE = re.compile(rb"[^\n]*\S[^\n]*(?:\n[^\n]*\S[^\n]*)*")
+
+
+class UnindexableSubtitle(ValueError):
+    pass
+
+
+class CueOffsets:
+    # A sidecar index of one subtitle file: the byte range, number and
+    # start/end of each cue. The sidecar and the subtitle are both mapped, so
+    # a window query binary-searches the start times and decodes only the
+    # bytes of the cues it returns.
+    def __init__(self, file_path: str, sidecar_path: str, parser: SubtitleParser) -> None:
+        self.file_path = file_path
+        self.parser = parser
+        with open(sidecar_path, "rb") as f:
+            self.__sidecar = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.size, self.mtime_ns, count, self.max_duration, is_sorted, encoding = HEADER.unpack_from(self.__sidecar)
+        if magic != MAGIC or version != VERSION:
+            self.__sidecar.close()
+            raise ValueError(f"{sidecar_path} is not a version {VERSION} cue offset index")
+        self.count = count
+        self.is_sorted = bool(is_sorted)
+        self.encoding = encoding.rstrip(b"\0").decode("ascii")
+        # Queries in progress, and whether the store has let go of this index;
+        # both only change under the store's lock.
+        self.readers = 0
+        self.retired = False
+
+        self.__view = memoryview(self.__sidecar)
+        offsets_end = HEADER.size + 8 * (count + 1)
+        self.offsets = self.__view[HEADER.size:offsets_end].cast("q")
+        self.indexes = self.__view[offsets_end:offsets_end + 4 * count].cast("i")
+        self.starts = self.__view[offsets_end + 4 * count:offsets_end + 8 * count].cast("i")
+        self.ends = self.__view[offsets_end + 8 * count:offsets_end + 12 * count].cast("i")
+
+        # Files are replaced by rename (see SubtitleWriter), so the mapped
+        # inode stays intact; callers check matches() before every query.
+        self.__data: Optional[mmap.mmap] = None
+        if count:
+            with open(file_path, "rb") as f:
+                self.__data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def build(cls, file_path: str, sidecar_path: str, parser: SubtitleParser) -> None:
+        # Applies the parser's block rules to the raw bytes: a block with a
+        # timing line starts a cue, and blocks without one belong to the cue
+        # before, so each cue runs up to the start of the next.
+        st = os.stat(file_path)
+        with open(file_path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                data = None
+            try:
+                encoding = parser.detect_encoding(data) if data is not None else "utf-8"
+                if encoding.startswith("utf-16"):
+                    raise UnindexableSubtitle(f"{file_path} is UTF-16, which cannot be indexed by byte offset")
+                columns = cls.__scan(data) if data is not None else (array("q", [0]), array("i"), array("i"), array("i"))
+            finally:
+                if data is not None:
+                    data.close()
+
+        offsets, indexes, starts, ends = columns
+        is_sorted = all(starts[i] <= starts[i + 1] for i in range(len(starts) - 1))
+        max_duration = max((end - start for start, end in zip(starts, ends)), default=0)
+        # The BOM is skipped by the scan, so cue slices decode as plain UTF-8.
+        encoding = "utf-8" if encoding == "utf-8-sig" else encoding
+        header = HEADER.pack(MAGIC, VERSION, st.st_size, st.st_mtime_ns, len(indexes), max_duration, is_sorted, encoding.encode("ascii"))
+
+        os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(sidecar_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for column in columns:
+                    column.tofile(f)
+            os.replace(tmp_path, sidecar_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def __scan(data: mmap.mmap) -> Tuple[array, array, array, array]:
+        offsets, indexes, starts, ends = array("q"), array("i"), array("i"), array("i")
+        start_at = len(codecs.BOM_UTF8) if data[:3] == codecs.BOM_UTF8 else 0
+        last_index = 0
+
+        for match in BLOCK_BYTES_RE.finditer(data, start_at):
+            lines = match.group().split(b"\n", 2)
+            for timing_line in range(min(2, len(lines))):
+                timing = parse_timing(lines[timing_line].decode("latin-1")) if b"-->" in lines[timing_line] else None
+                if timing is not None:
+                    break
+            else:
+                continue
+
+            number = lines[0].strip() if timing_line == 1 else b""
+            index = int(number) if number.isdigit() else last_index + 1
+            last_index = index
+
+            offsets.append(match.start())
+            indexes.append(index)
+            starts.append(timing[0])
+            ends.append(timing[1])
+
+        offsets.append(len(data))
+        return offsets, indexes, starts, ends
+
+    def matches(self, st: os.stat_result) -> bool:
+        return (st.st_size, st.st_mtime_ns) == (self.size, self.mtime_ns)
+
+    def window(self, from_ms: int = 0, to_ms: Optional[int] = None, limit: Optional[int] = None) -> List[Cue]:
+        # Cues on screen at any point in [from_ms, to_ms), in file order.
+        if not self.count:
+            return []
+        to_ms = to_ms if to_ms is not None else 2 ** 31 - 1
+
+        if self.is_sorted:
+            # No cue starting before from_ms - max_duration can still be on
+            # screen at from_ms.
+            lo = bisect_left(self.starts, from_ms - self.max_duration)
+            hi = bisect_left(self.starts, to_ms)
+        else:
+            lo, hi = 0, self.count
+
+        positions = []
+        for i in range(lo, hi):
+            if self.ends[i] > from_ms and self.starts[i] < to_ms:
+                positions.append(i)
+                if len(positions) == limit:
+                    break
+        if not positions:
+            return []
+
+        first, last = positions[0], positions[-1] + 1
+        view = memoryview(self.__data)[self.offsets[first]:self.offsets[last]]
+        try:
+            text = str(view, self.encoding, errors="replace")
+        finally:
+            view.release()
+
+        wanted = set(positions)
+        cues = []
+        for position, (_, start, end, cue_text) in zip(range(first, last), self.parser.iter_text_cues(text, self.file_path)):
+            if position in wanted:
+                cues.append((self.indexes[position], start, end, cue_text))
+        return cues
+
+    def close(self) -> None:
+        for view in (self.offsets, self.indexes, self.starts, self.ends, self.__view):
+            view.release()
+        self.__sidecar.close()
+        if self.__data is not None:
+            self.__data.close()
+
+
+class CueOffsetStore:
+    # Opens, builds and keeps a bounded number of CueOffsets, rebuilding a
+    # sidecar whenever its subtitle's size or mtime no longer match. An index
+    # evicted or replaced while a query is reading it is closed when the last
+    # such query is done.
+    def __init__(self, parser: SubtitleParser, cache_dir: str = DEFAULT_CACHE_DIR, max_open: int = 32) -> None:
+        self.parser = parser
+        self.directory = os.path.join(cache_dir, OFFSETS_DIR)
+        self.max_open = max_open
+        self.__open: "OrderedDict[str, CueOffsets]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, file_path: str) -> CueOffsets:
+        # The index may be closed by a later get() (eviction or a changed
+        # file); concurrent queries should go through window().
+        st = os.stat(file_path)
+        with self.__lock:
+            return self.__get(file_path, st)
+
+    def window(self, file_path: str, from_ms: int = 0, to_ms: Optional[int] = None, limit: Optional[int] = None) -> List[Cue]:
+        try:
+            offsets = self.__acquire(file_path)
+        except UnindexableSubtitle:
+            # Parse the whole file instead; correct, just not constant time.
+            to_ms = to_ms if to_ms is not None else 2 ** 31 - 1
+            cues = [cue for cue in subtitle_cache.get_file(file_path).cues() if cue[2] > from_ms and cue[1] < to_ms]
+            return cues[:limit] if limit is not None else cues
+        try:
+            return offsets.window(from_ms, to_ms, limit)
+        finally:
+            self.__release(offsets)
+
+    def __acquire(self, file_path: str) -> CueOffsets:
+        # get() and taking a reader under one lock, so the index cannot be
+        # closed in between.
+        st = os.stat(file_path)
+        with self.__lock:
+            offsets = self.__get(file_path, st)
+            offsets.readers += 1
+            return offsets
+
+    def __release(self, offsets: CueOffsets) -> None:
+        with self.__lock:
+            offsets.readers -= 1
+            if offsets.retired and not offsets.readers:
+                offsets.close()
+
+    def __retire(self, offsets: CueOffsets) -> None:
+        offsets.retired = True
+        if not offsets.readers:
+            offsets.close()
+
+    def __get(self, file_path: str, st: os.stat_result) -> CueOffsets:
+        offsets = self.__open.get(file_path)
+        if offsets is not None and offsets.matches(st):
+            self.__open.move_to_end(file_path)
+            return offsets
+
+        if offsets is not None:
+            self.__retire(self.__open.pop(file_path))
+        offsets = self.__load(file_path, st)
+        self.__open[file_path] = offsets
+        while len(self.__open) > self.max_open:
+            self.__retire(self.__open.popitem(last=False)[1])
+        return offsets
+
+    def __load(self, file_path: str, st: os.stat_result) -> CueOffsets:
+        sidecar_path = os.path.join(self.directory, hashlib.blake2b(file_path.encode("utf-8"), digest_size=16).hexdigest())
+        if os.path.exists(sidecar_path):
+            try:
+                offsets = CueOffsets(file_path, sidecar_path, self.parser)
+                if offsets.matches(st):
+                    return offsets
+                offsets.close()
+            except (ValueError, struct.error) as e:
+                logger.warning(f"Rebuilding unreadable cue offsets for {file_path}: {e}")
+
+        logger.debug("Building cue offsets for %s", file_path)
+        CueOffsets.build(file_path, sidecar_path, self.parser)
+        return CueOffsets(file_path, sidecar_path, self.parser)
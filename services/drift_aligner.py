@@ -0,0 +1,139 @@
+from typing import List, NamedTuple, Optional, Sequence
+import numpy as np
+from models.subtitle_track import SubtitleTrack
+from utils.logger import logger
+
+# Framerate conversions between releases: a 25 fps PAL rip of a 23.976 fps
+# source plays 4% fast, so its timestamps need stretching by 25/23.976 to line
+# up with the original, and so on.
+FPS_SCALES = (
+    1.0,
+    25 / 23.976, 23.976 / 25,
+    24 / 23.976, 23.976 / 24,
+    25 / 24, 24 / 25,
+)
+
+
+class DriftEstimate(NamedTuple):
+    scale: float
+    offset_ms: float
+    score: float
+
+
+class DriftAligner:
+    # Matches cues between two releases that are offset and/or running at a
+    # different framerate. The merge track's timings are mapped onto the base
+    # track as t * scale + offset, estimated by cross-correlating histograms of
+    # when a cue is on screen, then cues are matched by maximal overlap.
+    def __init__(self, bin_ms: int = 100, max_offset_ms: int = 120_000, scales: Sequence[float] = FPS_SCALES, window: int = 4) -> None:
+        self.bin_ms = bin_ms
+        self.max_offset_ms = max_offset_ms
+        self.scales = tuple(scales)
+        # Merge cues that start before a base cue ends are checked this many at
+        # a time, nearest first; more than a few cues on screen at once is rare.
+        self.window = window
+
+    def align(self, base_track: SubtitleTrack, merge_track: SubtitleTrack) -> List[Optional[int]]:
+        if not len(base_track) or not len(merge_track):
+            return [None] * len(base_track)
+
+        base_starts, base_ends = self.__times(base_track)
+        merge_starts, merge_ends = self.__times(merge_track)
+
+        estimate = self.estimate(base_starts, base_ends, merge_starts, merge_ends)
+        scale, offset = estimate.scale, estimate.offset_ms
+        matches, overlaps = self.match(base_starts, base_ends, merge_starts * scale + offset, merge_ends * scale + offset)
+
+        # The histogram search only finds the offset to within a bin and the
+        # scale from a fixed list, so fit the matched pairs once more.
+        refined = self.__refine(base_starts, merge_starts, matches)
+        if refined is not None:
+            scale, offset = refined
+            refined_matches, refined_overlaps = self.match(base_starts, base_ends, merge_starts * scale + offset, merge_ends * scale + offset)
+            if refined_overlaps.sum() >= overlaps.sum():
+                matches = refined_matches
+
+        logger.debug("Drift estimate: scale %.5f, offset %.0fms (score %.3f)", scale, offset, estimate.score)
+        return [int(i) if i >= 0 else None for i in matches.tolist()]
+
+    def estimate(self, base_starts: np.ndarray, base_ends: np.ndarray, merge_starts: np.ndarray, merge_ends: np.ndarray) -> DriftEstimate:
+        max_lag = self.max_offset_ms // self.bin_ms
+        horizon = max(base_ends.max(), merge_ends.max() * max(self.scales)) + self.max_offset_ms
+        bins = int(horizon // self.bin_ms) + 2
+        size = 1 << int(2 * bins - 1).bit_length()
+
+        base_hist = self.__activity(base_starts, base_ends, bins)
+        base_spectrum = np.fft.rfft(base_hist, size)
+        base_norm = np.sqrt(base_hist.sum())
+
+        best = DriftEstimate(1.0, 0.0, -1.0)
+        for scale in self.scales:
+            merge_hist = self.__activity(merge_starts * scale, merge_ends * scale, bins)
+            # corr[k] is how much of the base is covered by the merge track
+            # shifted k bins later; negative shifts wrap around to the end.
+            corr = np.fft.irfft(base_spectrum * np.conj(np.fft.rfft(merge_hist, size)), size)
+            lags = np.concatenate((corr[:max_lag + 1], corr[size - max_lag:]))
+            k = int(lags.argmax())
+            lag = k if k <= max_lag else k - len(lags)
+
+            # Cosine similarity, so stretching the merge cues doesn't win just
+            # by covering more bins.
+            score = float(lags[k] / max(base_norm * np.sqrt(merge_hist.sum()), 1e-9))
+            if score > best.score:
+                best = DriftEstimate(scale, float(lag * self.bin_ms), score)
+
+        return best
+
+    def match(self, base_starts: np.ndarray, base_ends: np.ndarray, merge_starts: np.ndarray, merge_ends: np.ndarray):
+        # For each base cue, the merge cues starting before it ends are found
+        # with searchsorted, and the one with the largest overlap among the
+        # nearest few wins. Returns original merge indices (-1 for no match)
+        # and the overlap of each match.
+        order = np.argsort(merge_starts, kind="stable")
+        starts = merge_starts[order]
+        ends = merge_ends[order]
+
+        hi = np.searchsorted(starts, base_ends, side="left")
+        best = np.full(len(base_starts), -1, dtype=np.int64)
+        best_overlap = np.zeros(len(base_starts))
+
+        for j in range(1, self.window + 1):
+            k = hi - j
+            valid = k >= 0
+            k = np.where(valid, k, 0)
+            overlap = np.minimum(base_ends, ends[k]) - np.maximum(base_starts, starts[k])
+            better = valid & (overlap > best_overlap)
+            best = np.where(better, order[k], best)
+            best_overlap = np.where(better, overlap, best_overlap)
+
+        return best, best_overlap
+
+    def __refine(self, base_starts: np.ndarray, merge_starts: np.ndarray, matches: np.ndarray) -> Optional[tuple]:
+        matched = matches >= 0
+        if matched.sum() < 10:
+            return None
+
+        x = merge_starts[matches[matched]]
+        y = base_starts[matched]
+        scale, offset = np.polyfit(x, y, 1)
+
+        # Drop pairs far off the line (usually a cue split differently between
+        # releases) and fit again.
+        residuals = np.abs(y - (x * scale + offset))
+        keep = residuals <= max(3 * np.median(residuals), self.bin_ms)
+        if keep.sum() >= 10:
+            scale, offset = np.polyfit(x[keep], y[keep], 1)
+        return float(scale), float(offset)
+
+    def __activity(self, starts: np.ndarray, ends: np.ndarray, bins: int) -> np.ndarray:
+        # 1 for every bin a cue is on screen, built from +1/-1 steps at cue
+        # starts and ends.
+        first = np.clip(starts // self.bin_ms, 0, bins).astype(np.int64)
+        last = np.clip(np.ceil(ends / self.bin_ms), 0, bins).astype(np.int64)
+        steps = np.bincount(first, minlength=bins + 1) - np.bincount(last, minlength=bins + 1)
+        return (np.cumsum(steps[:bins]) > 0).astype(np.float64)
+
+    def __times(self, track: SubtitleTrack):
+        starts = np.frombuffer(track.starts, dtype=np.int32).astype(np.float64)
+        ends = np.frombuffer(track.ends, dtype=np.int32).astype(np.float64)
+        return starts, ends
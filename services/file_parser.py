@@ -1,110 +1,245 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import os
-import re
-from typing import DefaultDict, TypedDict, Dict, Optional, Tuple
+import time
+from typing import DefaultDict, Dict, Iterator, List, Optional, Tuple, TypedDict
 from models.media_item import Episode, Library, Movie, Season, TVShow
+from models.subtitle import Subtitle
+from services.scan_index import ScanIndex
 from services.subtitle_parser import SubtitleParser
 from utils.logger import logger
+from utils.metrics import stage_seconds
+from utils.release_name import ReleaseName, parse_release_name
 
 class ContentEntry(TypedDict):
     video: Optional[str]
     subtitles: Dict[str, str]
 
+class DirListing(TypedDict):
+    path: str
+    dirs: List[str]
+    files: List[str]
+
 class FileParser:
-    def __init__(self, library: Library,subtitle_parser: SubtitleParser) -> None:
+    def __init__(self, library: Library,subtitle_parser: SubtitleParser, max_workers: Optional[int] = None, index: Optional[ScanIndex] = None) -> None:
         self.library=library
         self.subtitle_parser=subtitle_parser
+        self.max_workers=max_workers
+        self.index=index
+        self.timings: Dict[str, float] = {}
+        self.phase: Optional[str] = None
+
+    def parse(self, directory: str, full_rebuild: bool = False, only: Optional[str] = None):
+        self.timings = {}
+        if self.index:
+            with self.__phase("load_index"):
+                if full_rebuild:
+                    self.index.clear()
+                else:
+                    self.index.load()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            # Each phase fans out over the pool and is collected with map(), so
+            # results come back in listing order and the Library is built in the
+            # same order a serial walk would produce.
+            with self.__phase("list"):
+                top = self.__list_dir(directory)
+                for file in top["files"]:
+                    logger.debug(f"Skipping {file}, not a directory.")
+                if only is not None:
+                    top = {"path": top["path"], "dirs": [name for name in top["dirs"] if name == only], "files": []}
+                folders = list(pool.map(self.__list_dir, [f"{directory}/{name}" for name in top["dirs"]]))
+
+            # A folder with sub-folders is a TV show and each sub-folder a season;
+            # anything else is a movie folder.
+            with self.__phase("list_seasons"):
+                content_dirs: List[DirListing] = []
+                shows: List[Tuple[str, List[DirListing]]] = []
+                movies: List[Tuple[str, DirListing]] = []
+                season_paths = [f"{listing['path']}/{name}" for listing in folders for name in listing["dirs"]]
+                seasons = iter(pool.map(self.__list_dir, season_paths))
+                for name, listing in zip(top["dirs"], folders):
+                    if listing["dirs"]:
+                        show_seasons = [next(seasons) for _ in listing["dirs"]]
+                        shows.append((name, show_seasons))
+                        content_dirs.extend(show_seasons)
+                    else:
+                        movies.append((name, listing))
+                        content_dirs.append(listing)
+
+            with self.__phase("content"):
+                contents = dict(zip(
+                    (listing["path"] for listing in content_dirs),
+                    pool.map(self.__find_content, content_dirs),
+                ))
+
+            # Only metadata is gathered here; cue entries are parsed on first
+            # access through the subtitle cache.
+            with self.__phase("subtitles"):
+                subtitle_files = [
+                    (subtitle_file, lang_tag)
+                    for content in contents.values()
+                    for data in content.values()
+                    for lang_tag, subtitle_file in data["subtitles"].items()
+                ]
+                subtitles = dict(zip(
+                    (subtitle_file for subtitle_file, _ in subtitle_files),
+                    pool.map(self.__describe_subtitle, subtitle_files),
+                ))
+
+        with self.__phase("build"):
+            for name, show_seasons in shows:
+                self.__process_tv_show(name, show_seasons, contents, subtitles)
+            for name, listing in movies:
+                self.__process_movie(name, listing, contents, subtitles)
+
+        if self.index:
+            with self.__phase("save_index"):
+                self.index.save(partial=only is not None)
+
+        logger.info(
+            f"Scanned {directory}: {len(shows)} TV shows, {len(movies)} movies, {len(subtitle_files)} subtitles "
+            + ", ".join(f"{phase}={seconds:.3f}s" for phase, seconds in self.timings.items())
+        )
 
-    def parse(self, directory: str):
-        files = os.listdir(directory)
-        for file in files:
-            path = rf"{directory}/{file}"
-            if not os.path.isdir(path):
-                logger.debug(f"Skipping {file}, not a directory.")
-                continue
-
-            if(self.__is_tv_show_folder(path)):
-                tv_show = TVShow(name=file,seasons=[])
-                self.__process_tv_show(path,file)
-                pass
-            else:
-                self.__process_movie(path,file)
-            
-                # Is Movie
 
+    def __process_tv_show(self, tv_show_name: str, seasons: List[DirListing], contents: Dict[str, DefaultDict[str, ContentEntry]], subtitles: Dict[str, Subtitle]):
 
-    def __process_tv_show(self, path: str, tv_show_name: str):
-        
         tv_show=TVShow(name=tv_show_name,seasons=[])
         self.library.add_tv_show(tv_show)
 
         # If a TV show, then we can assume the next level of folders are seasons.
 
-        seasons = os.listdir(path)
-        for season_name in seasons:
-
-            season = Season(name=season_name,episodes=[])
+        for listing in seasons:
+            season_path = listing["path"]
+            season = Season(name=os.path.basename(season_path),episodes=[])
             tv_show.add_season(season)
 
-            season_path = rf"{path}/{season_name}"
-            content = self.__find_content(season_path)
-            for episode, data in content.items():
-                subtitles=[]
-                video_path=f"{season_path}/{data['video']}"
-                for _,subtitle_file in data['subtitles'].items():
-                    subtitle=self.subtitle_parser.parse_srt_file(subtitle_file)
-                    subtitles.append(subtitle)
-
-                episode = Episode(name=episode,path=video_path,subtitles=subtitles)
-                season.add_episode(episode)
-
-    
-    def __process_movie(self, path: str, movie_name: str):
-        content=self.__find_content(path)  
-
-        subtitles=[]
-        for _, data in content.items():
-            for _,subtitle_file in data['subtitles']:
-                subtitle=self.subtitle_parser.parse_srt_file(subtitle_file)
-                subtitles.append(subtitle)
-
-            movie = Movie(name=movie_name,path=path,subtitles=subtitles)
-            
-            self.library.add_movie(movie)
-
-
-
-
-    def __is_tv_show_folder(self, folder_path: str) -> bool:
-        for entry in os.scandir(folder_path):
-            if entry.is_dir():
-                return True
-        return False
-    
-    def __find_content(self, path: str, video_exts: Tuple=(".mkv", ".mp4", ".avi"), sub_ext: str=".srt") -> DefaultDict[str, ContentEntry]:
+            for episode, data in contents[season_path].items():
+                season.add_episode(self.__build_episode(season_path, episode, data, subtitles))
+
+    def scan_episodes(self, season_path: str) -> List[Episode]:
+        # Rebuilds the episodes of a single season folder, for targeted updates
+        # that should not go through a full parse().
+        content = self.__find_content(self.__read_dir(season_path))
+        subtitles = {
+            subtitle_file: self.__describe_subtitle((subtitle_file, lang_tag))
+            for data in content.values()
+            for lang_tag, subtitle_file in data["subtitles"].items()
+        }
+        return [self.__build_episode(season_path, episode, data, subtitles) for episode, data in content.items()]
+
+    def __build_episode(self, season_path: str, name: str, data: ContentEntry, subtitles: Dict[str, Subtitle]) -> Episode:
+        video_path=f"{season_path}/{data['video']}"
+        episode_subtitles=[subtitles[subtitle_file] for subtitle_file in data['subtitles'].values()]
+        return Episode(name=name,path=video_path,subtitles=episode_subtitles)
+
+
+    def __process_movie(self, movie_name: str, listing: DirListing, contents: Dict[str, DefaultDict[str, ContentEntry]], subtitles: Dict[str, Subtitle]):
+        path = listing["path"]
+        movie_subtitles=[
+            subtitles[subtitle_file]
+            for data in contents[path].values()
+            for subtitle_file in data['subtitles'].values()
+        ]
+
+        movie = Movie(name=movie_name,path=path,subtitles=movie_subtitles)
+        self.library.add_movie(movie)
+
+
+    def __list_dir(self, path: str) -> DirListing:
+        # A directory's mtime changes whenever an entry is added, removed or
+        # renamed, so an unchanged mtime means the indexed listing is current.
+        if self.index:
+            mtime_ns = os.stat(path).st_mtime_ns
+            record = self.index.get_dir(path, mtime_ns)
+            if record:
+                self.index.put_dir(path, record)
+                return {"path": path, "dirs": record[1], "files": record[2]}
+
+        listing = self.__read_dir(path)
+        if self.index:
+            self.index.put_dir(path, (mtime_ns, listing["dirs"], listing["files"]))
+        return listing
+
+    def __read_dir(self, path: str) -> DirListing:
+        # DirEntry.is_dir() answers from the d_type returned by readdir, so this
+        # costs a single directory read and no per-entry stat on most filesystems.
+        listing: DirListing = {"path": path, "dirs": [], "files": []}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    listing["dirs"].append(entry.name)
+                else:
+                    listing["files"].append(entry.name)
+        return listing
+
+    def __describe_subtitle(self, subtitle_file: Tuple[str, str]) -> Subtitle:
+        file_path, lang_tag = subtitle_file
+        return Subtitle(file_path=file_path, format='srt', language=lang_tag, size=os.stat(file_path).st_size)
+
+    @contextmanager
+    def __phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        self.phase = name
+        try:
+            yield
+        finally:
+            self.phase = None
+            elapsed = time.perf_counter() - started
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            stage_seconds.observe(elapsed, stage=f"scan_{name}")
+
+    def __find_content(self, listing: DirListing, video_exts: Tuple=(".mkv", ".mp4", ".avi"), sub_ext: str=".srt") -> DefaultDict[str, ContentEntry]:
+        # Entries are keyed by video stem. A subtitle named exactly like its
+        # video goes with it directly; one named differently ("House-S01E07-x"
+        # next to "House.S01E07") is paired by season and episode instead, as
+        # long as the folder has a single video for that episode and no other
+        # subtitle already holds that language for it.
         content: DefaultDict[str, ContentEntry] = defaultdict(
             lambda: {"video": None, "subtitles": {}}
         )
+        path = listing["path"]
 
-
-        for filename in os.listdir(path):
-            lower = filename.lower()
+        by_episode: Dict[Tuple[int, int], Optional[str]] = {}
+        subtitle_files: List[Tuple[str, ReleaseName]] = []
+        for filename in listing["files"]:
             name, ext = os.path.splitext(filename)
 
-            if ext in video_exts:
+            if ext.lower() in video_exts:
                 content[name]["video"] = filename
+                key = parse_release_name(filename).episode_key
+                if key is not None:
+                    # Two videos of one episode make it ambiguous.
+                    by_episode[key] = name if key not in by_episode else None
                 continue
 
-            if lower.endswith(sub_ext):
-                match = re.match(r"(.+?)\.((?:\w+\.)*\w+)\.srt", filename)
-                if match:
-                    stem, lang_tag = match.groups()
-                    content[stem]["subtitles"][lang_tag] = f"{path}/{filename}"
+            if filename.lower().endswith(sub_ext):
+                release = parse_release_name(filename)
+                if release.language is not None:
+                    subtitle_files.append((filename, release))
+
+        # Exact stems first, so they keep their language even when a loosely
+        # named subtitle for the same episode comes earlier in the listing.
+        targets = {filename: release.stem for filename, release in subtitle_files if release.stem in content}
+        claimed = {(targets[filename], release.language) for filename, release in subtitle_files if filename in targets}
+        for filename, release in subtitle_files:
+            if filename in targets:
+                continue
+            entry = release.stem
+            key = release.episode_key
+            if key is not None:
+                # In a folder without videos, the first subtitle of an episode
+                # names the entry the others join.
+                owner = by_episode.setdefault(key, release.stem)
+                if owner is not None and (owner, release.language) not in claimed:
+                    entry = owner
+            claimed.add((entry, release.language))
+            targets[filename] = entry
+
+        for filename, release in subtitle_files:
+            content[targets[filename]]["subtitles"][release.language] = f"{path}/{filename}"
 
         return content
 
-
-
-
-
-
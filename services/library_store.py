@@ -0,0 +1,153 @@
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from pydantic import BaseModel
+from models.media_item import Library
+from services.file_parser import FileParser
+from services.scan_index import ScanIndex
+from services.search_index import SearchIndex
+from services.subtitle_parser import SubtitleParser
+from utils.logger import logger
+
+
+class RescanStatus(BaseModel):
+    state: str = "idle"  # idle, running, done or failed
+    show: Optional[str] = None
+    full_rebuild: bool = False
+    phase: Optional[str] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    seconds: Optional[float] = None
+    timings: Dict[str, float] = {}
+    tv_shows: int = 0
+    movies: int = 0
+    error: Optional[str] = None
+
+
+class RescanInProgress(Exception):
+    pass
+
+
+class LibraryStore:
+    # Holds the Library snapshot the API serves. Rescans build a new Library on
+    # a background thread and swap it in with a single reference assignment,
+    # so requests keep reading the previous snapshot until the new one is
+    # complete. The search index is synced after the swap, on a thread of its
+    # own, so a slow sync never holds back the library; syncs run one at a
+    # time in the order their rescans finished.
+    def __init__(self, directory: str, subtitle_parser: SubtitleParser, index: Optional[ScanIndex] = None, search_index: Optional[SearchIndex] = None) -> None:
+        self.directory = directory
+        self.subtitle_parser = subtitle_parser
+        self.index = index
+        self.search_index = search_index
+        self.library = Library(movies=[], tv_shows=[])
+        self.__status = RescanStatus()
+        self.__file_parser: Optional[FileParser] = None
+        self.__lock = threading.Lock()
+        self.__done = threading.Event()
+        self.__search_queue: "queue.Queue[tuple]" = queue.Queue()
+        self.__search_pending = 0
+        self.__search_idle = threading.Event()
+        self.__search_idle.set()
+        if search_index is not None:
+            threading.Thread(target=self.__sync_search, name="search-sync", daemon=True).start()
+
+    @property
+    def status(self) -> RescanStatus:
+        status = self.__status.model_copy()
+        if self.__file_parser is not None:
+            status.phase = self.__file_parser.phase
+            status.timings = dict(self.__file_parser.timings)
+        return status
+
+    def start_rescan(self, show: Optional[str] = None, full_rebuild: bool = False) -> RescanStatus:
+        with self.__lock:
+            if self.__status.state == "running":
+                raise RescanInProgress(f"A rescan started at {self.__status.started_at} is still running")
+
+            self.__status = RescanStatus(state="running", show=show, full_rebuild=full_rebuild, started_at=datetime.now(timezone.utc))
+            self.__file_parser = FileParser(Library(movies=[], tv_shows=[]), self.subtitle_parser, index=self.index)
+            self.__done.clear()
+
+        threading.Thread(target=self.__rescan, args=(self.__file_parser, show, full_rebuild), name="library-rescan", daemon=True).start()
+        return self.status
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.__done.wait(timeout)
+
+    def wait_search(self, timeout: Optional[float] = None) -> bool:
+        return self.__search_idle.wait(timeout)
+
+    def __rescan(self, file_parser: FileParser, show: Optional[str], full_rebuild: bool) -> None:
+        started = time.perf_counter()
+        try:
+            file_parser.parse(self.directory, full_rebuild=full_rebuild, only=show)
+            self.library = self.__merge_snapshot(file_parser.library, show)
+        except Exception as e:
+            logger.exception(f"Rescan of {show or self.directory} failed")
+            self.__finish(file_parser, started, state="failed", error=str(e))
+        else:
+            logger.info(f"Rescan of {show or self.directory} finished in {time.perf_counter() - started:.2f}s")
+            self.__finish(file_parser, started, state="done")
+            if self.search_index is not None:
+                # The scanned library, not the merged snapshot: a single-folder
+                # rescan only needs that folder's subtitles statted.
+                with self.__lock:
+                    self.__search_pending += 1
+                    self.__search_idle.clear()
+                self.__search_queue.put((file_parser.library, show))
+
+    def __sync_search(self) -> None:
+        while True:
+            library, show = self.__search_queue.get()
+            started = time.perf_counter()
+            try:
+                self.search_index.sync(library, scope=show)
+            except Exception:
+                logger.exception(f"Search index sync of {show or self.directory} failed")
+            else:
+                logger.info(f"Search index sync of {show or self.directory} finished in {time.perf_counter() - started:.2f}s")
+            with self.__lock:
+                self.__search_pending -= 1
+                if not self.__search_pending:
+                    self.__search_idle.set()
+
+    def __merge_snapshot(self, scanned: Library, show: Optional[str]) -> Library:
+        if show is None:
+            return scanned
+
+        # A single-folder rescan replaces that show or movie in place and keeps
+        # everything else from the current snapshot. A folder that has gone
+        # away is dropped, and a new one is appended.
+        current = self.library
+        return Library(
+            movies=self.__replace(current.movies, scanned.movies, show),
+            tv_shows=self.__replace(current.tv_shows, scanned.tv_shows, show),
+        )
+
+    def __replace(self, current: list, scanned: list, name: str) -> list:
+        items = []
+        for item in current:
+            if item.name != name:
+                items.append(item)
+            elif scanned:
+                items.extend(scanned)
+                scanned = []
+        items.extend(scanned)
+        return items
+
+    def __finish(self, file_parser: FileParser, started: float, state: str, error: Optional[str] = None) -> None:
+        with self.__lock:
+            self.__status = self.__status.model_copy(update={
+                "state": state,
+                "finished_at": datetime.now(timezone.utc),
+                "seconds": time.perf_counter() - started,
+                "timings": dict(file_parser.timings),
+                "tv_shows": len(self.library.tv_shows),
+                "movies": len(self.library.movies),
+                "error": error,
+            })
+            self.__file_parser = None
+        self.__done.set()
@@ -0,0 +1,373 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from models.media_item import Episode, Season
+from services.batch_merger import BatchMerger
+from services.file_parser import FileParser
+from services.library_store import LibraryStore, RescanInProgress
+from services.search_index import Owner
+from services.subtitle_cache import subtitle_cache
+from utils.logger import logger
+
+# (directories whose entries changed, subtitle files whose contents changed)
+Changes = Tuple[Set[str], Set[str]]
+
+# Watches go three levels deep: the library root, show/movie folders and
+# season folders.
+WATCH_DEPTH = 2
+
+
+class InotifyBackend:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, root: str) -> None:
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.__libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self.root = root.rstrip("/")
+        self.__fd = self.__libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.__paths: Dict[int, str] = {}
+        self.__watch_tree(self.root, 0)
+
+    def poll(self, timeout: float) -> Optional[Changes]:
+        # None means the kernel queue overflowed and events were lost.
+        ready, _, _ = select.select([self.__fd], [], [], timeout)
+        dirs: Set[str] = set()
+        files: Set[str] = set()
+        if not ready:
+            return dirs, files
+
+        try:
+            data = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return dirs, files
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            path = self.__paths.get(wd)
+            if path is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.__paths[wd]
+                continue
+
+            if mask & self.IN_DELETE_SELF:
+                dirs.add(os.path.dirname(path))
+            elif mask & self.IN_CLOSE_WRITE and not mask & self.IN_ISDIR:
+                files.add(f"{path}/{name}")
+            else:
+                dirs.add(path)
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and mask & self.IN_ISDIR:
+                    self.__watch_tree(f"{path}/{name}", self.__depth(path) + 1)
+        return dirs, files
+
+    def close(self) -> None:
+        os.close(self.__fd)
+
+    def __depth(self, path: str) -> int:
+        return 0 if path == self.root else path[len(self.root) + 1:].count("/") + 1
+
+    def __watch_tree(self, path: str, depth: int) -> None:
+        if depth > WATCH_DEPTH:
+            return
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            logger.warning(f"Could not watch {path}: {os.strerror(ctypes.get_errno())}")
+            return
+        self.__paths[wd] = path
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        self.__watch_tree(entry.path, depth + 1)
+        except OSError:
+            pass
+
+
+class PollingBackend:
+    # For mounts without inotify (network shares, WSL drvfs). Each poll stats
+    # the watched directories and subtitle files; only directories whose mtime
+    # moved are listed again.
+    def __init__(self, root: str) -> None:
+        self.root = root.rstrip("/")
+        self.__dirs: Dict[str, int] = {}
+        self.__files: Dict[str, Tuple[int, int]] = {}
+        self.__snapshot(self.root, 0)
+
+    def poll(self, timeout: float) -> Optional[Changes]:
+        time.sleep(timeout)
+        dirs: Set[str] = set()
+        files: Set[str] = set()
+
+        for path, mtime_ns in list(self.__dirs.items()):
+            try:
+                current = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                del self.__dirs[path]
+                dirs.add(os.path.dirname(path))
+                continue
+            if current != mtime_ns:
+                dirs.add(path)
+                self.__snapshot(path, self.__depth(path))
+
+        for path, signature in list(self.__files.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.__files[path]
+                continue
+            if (stat.st_mtime_ns, stat.st_size) != signature:
+                self.__files[path] = (stat.st_mtime_ns, stat.st_size)
+                files.add(path)
+        return dirs, files
+
+    def close(self) -> None:
+        pass
+
+    def __depth(self, path: str) -> int:
+        return 0 if path == self.root else path[len(self.root) + 1:].count("/") + 1
+
+    def __snapshot(self, path: str, depth: int) -> None:
+        if depth > WATCH_DEPTH:
+            return
+        try:
+            self.__dirs[path] = os.stat(path).st_mtime_ns
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if entry.path not in self.__dirs:
+                            self.__snapshot(entry.path, depth + 1)
+                    elif entry.name.lower().endswith(".srt") and entry.path not in self.__files:
+                        stat = entry.stat()
+                        self.__files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            self.__dirs.pop(path, None)
+
+
+class LibraryWatcher:
+    def __init__(self, store: LibraryStore, poll_interval: float = 5.0, debounce: float = 2.0, use_inotify: bool = True, auto_merge: bool = False, batch_merger: Optional[BatchMerger] = None) -> None:
+        self.store = store
+        self.root = store.directory.rstrip("/")
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        # Episodes are merged the way a batch run would: the same language
+        # selection, output path, format and merge cache.
+        self.batch_merger = (batch_merger or BatchMerger(max_workers=1)) if auto_merge else None
+        self.file_parser = FileParser(store.library, store.subtitle_parser)
+        self.__stop = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.__thread = threading.Thread(target=self.run, name="library-watcher", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def run(self) -> None:
+        backend = self.__create_backend()
+        pending_dirs: Set[str] = set()
+        pending_files: Set[str] = set()
+        last_event = 0.0
+        try:
+            while not self.__stop.is_set():
+                timeout = self.debounce if pending_dirs or pending_files else self.poll_interval
+                changes = backend.poll(timeout)
+                if changes is None:
+                    logger.warning("Watcher lost events, rescanning the library")
+                    pending_dirs, pending_files = set(), set()
+                    self.__rescan(None)
+                    continue
+
+                dirs, files = changes
+                if dirs or files:
+                    pending_dirs |= dirs
+                    pending_files |= files
+                    last_event = time.monotonic()
+                    continue
+
+                # Quiet for a whole debounce window: apply what piled up.
+                if (pending_dirs or pending_files) and time.monotonic() - last_event >= self.debounce:
+                    if self.__apply(pending_dirs, pending_files):
+                        pending_dirs, pending_files = set(), set()
+        finally:
+            backend.close()
+
+    def __create_backend(self):
+        if self.use_inotify:
+            try:
+                backend = InotifyBackend(self.root)
+                logger.info(f"Watching {self.root} with inotify")
+                return backend
+            except OSError as e:
+                logger.info(f"inotify unavailable ({e}), falling back to polling")
+        logger.info(f"Watching {self.root} by polling every {self.poll_interval}s")
+        return PollingBackend(self.root)
+
+    def __apply(self, dirs: Set[str], files: Set[str]) -> bool:
+        # Returns False to keep the changes pending while a rescan owns the
+        # library; they are applied to the new snapshot once it is in place.
+        if self.store.status.state == "running":
+            return False
+
+        library = self.store.library
+        self.file_parser.library = library
+        rescans: Set[str] = set()
+        # Subtitles of the seasons and files updated here, for the search
+        # index; None for paths that left the library.
+        touched: Dict[str, Optional[Owner]] = {}
+
+        for path in sorted(dirs):
+            parts = self.__relative_parts(path)
+            if parts is None:
+                continue
+            if not parts:
+                rescans |= self.__changed_top_level(library)
+            elif len(parts) == 1:
+                # A show gained or lost a season, or a movie folder changed.
+                rescans.add(parts[0])
+            elif len(parts) == 2:
+                show, season_name = parts
+                season = library.get_season(show, season_name)
+                if season is None:
+                    rescans.add(show)
+                else:
+                    self.__update_season(path, show, season, touched)
+
+        for path in sorted(files):
+            parts = self.__relative_parts(os.path.dirname(path))
+            if parts and len(parts) == 2 and path.lower().endswith(".srt") and os.path.dirname(path) not in dirs:
+                self.__refresh_subtitle(parts[0], library.get_season(*parts), path, touched)
+
+        for show in sorted(rescans):
+            self.__rescan(show)
+
+        # Rescans sync the folders they cover; this picks up the targeted
+        # updates, statting only the subtitles they touched.
+        if self.store.search_index is not None:
+            self.store.search_index.sync_paths(touched)
+        return True
+
+    def __changed_top_level(self, library) -> Set[str]:
+        with os.scandir(self.root) as entries:
+            on_disk = {entry.name for entry in entries if entry.is_dir()}
+        known = {tv_show.name for tv_show in library.tv_shows} | {movie.name for movie in library.movies}
+        return on_disk ^ known
+
+    def __update_season(self, season_path: str, show: str, season: Season, touched: Dict[str, Optional[Owner]]) -> None:
+        previous_paths = {subtitle.file_path for episode in season.episodes for subtitle in episode.subtitles}
+        try:
+            scanned = self.file_parser.scan_episodes(season_path)
+        except FileNotFoundError:
+            scanned = []
+
+        current = {episode.name: episode for episode in season.episodes}
+        names = {episode.name for episode in scanned}
+        for episode in list(season.episodes):
+            if episode.name not in names:
+                season.remove_episode(episode)
+                logger.info(f"Removed episode {episode.name}")
+
+        for episode in scanned:
+            existing = current.get(episode.name)
+            if existing is None:
+                season.add_episode(episode)
+                logger.info(f"Added episode {episode.name}")
+                self.__maybe_merge(episode)
+                continue
+
+            # Keep the Subtitle objects that did not change, so their cached
+            # tracks stay valid.
+            known = {(s.file_path, s.size): s for s in existing.subtitles}
+            subtitles = [known.get((s.file_path, s.size), s) for s in episode.subtitles]
+            if [id(s) for s in subtitles] != [id(s) for s in existing.subtitles]:
+                existing.subtitles = subtitles
+                existing.path = episode.path
+                self.store.library.touch()
+                logger.info(f"Updated subtitles of {existing.name}")
+                self.__maybe_merge(existing)
+
+        if self.store.search_index is not None:
+            current = dict(self.store.search_index.season_subtitles(show, season))
+            touched.update(dict.fromkeys(previous_paths - current.keys()))
+            touched.update(current)
+
+    def __refresh_subtitle(self, show: str, season: Optional[Season], path: str, touched: Dict[str, Optional[Owner]]) -> None:
+        if season is None:
+            return
+        for episode in season.episodes:
+            for subtitle in episode.subtitles:
+                if subtitle.file_path == path:
+                    subtitle_cache.invalidate(path)
+                    subtitle.size = os.stat(path).st_size
+                    subtitle.entry_count = None
+                    self.store.library.touch()
+                    logger.info(f"Refreshed {path}")
+                    if self.store.search_index is not None:
+                        touched.update((file_path, owner) for file_path, owner in self.store.search_index.season_subtitles(show, season) if file_path == path)
+                    return
+
+    def __maybe_merge(self, episode: Episode) -> None:
+        # An output that is already up to date (including our own merge
+        # showing up as a new subtitle) is left alone.
+        if self.batch_merger is None:
+            return
+        job = self.batch_merger.build_job(episode.subtitles)
+        if job is None:
+            return
+        try:
+            if self.batch_merger.merge(job):
+                logger.info(f"Merged subtitles of {episode.name} into {job.output_path}")
+        except Exception as e:
+            logger.error(f"Auto-merge of {episode.name} failed: {e}")
+
+    def __rescan(self, show: Optional[str]) -> None:
+        # Rescans run one at a time, so wait for each before the next update.
+        try:
+            self.store.start_rescan(show=show)
+        except RescanInProgress:
+            self.store.wait()
+            self.store.start_rescan(show=show)
+        self.store.wait()
+
+    def __relative_parts(self, path: str) -> Optional[List[str]]:
+        path = path.rstrip("/")
+        if path == self.root:
+            return []
+        if not path.startswith(self.root + "/"):
+            return None
+        return path[len(self.root) + 1:].split("/")
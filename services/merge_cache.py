@@ -0,0 +1,219 @@
+import hashlib
+import mmap
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from typing import Dict, NamedTuple, Sequence, Tuple
+from services.scan_index import DEFAULT_CACHE_DIR
+from services.subtitle_writer import FILE_MODE
+from utils.logger import logger
+
+CACHE_FILE = "merge_cache.sqlite3"
+RESULTS_DIR = "merges"
+SCHEMA_VERSION = 1
+# Part of every key; bump it when a change to the merger alters its output,
+# so results from older code are not reused. 2: cues with a missing
+# timestamp are dropped by the parser instead of joined onto the one before.
+MERGE_VERSION = 2
+
+# (key, size, mtime_ns) of the output as written
+OutputRecord = Tuple[str, int, int]
+
+
+class MergeCacheStats(NamedTuple):
+    hits: int
+    restored: int
+    misses: int
+    stale: int
+
+    def __str__(self) -> str:
+        return f"merge cache: {self.hits} up to date, {self.restored} reused, {self.misses} merged ({self.stale} stale)"
+
+
+class MergeCache:
+    # Remembers which inputs produced each merged file, keyed by a content
+    # hash of the input subtitles plus the merge parameters, and keeps a copy
+    # of every result. A merge whose inputs and output are unchanged is
+    # skipped, and one with the same content as a merge done before (e.g. a
+    # duplicate release) gets the stored result copied into place instead.
+    # Only results that some output still holds are kept: a result is deleted
+    # once the last output recorded with its key is merged again with a
+    # different one, and prune() drops outputs that are gone.
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR) -> None:
+        self.path = os.path.join(cache_dir, CACHE_FILE)
+        self.results_dir = os.path.join(cache_dir, RESULTS_DIR)
+        self.outputs: Dict[str, OutputRecord] = {}
+        self.__lock = threading.Lock()
+        self.__changed = False
+        self.__reset_stats()
+
+    @property
+    def stats(self) -> MergeCacheStats:
+        return MergeCacheStats(self.hits, self.restored, self.misses, self.stale)
+
+    def load(self) -> None:
+        self.outputs = {}
+        self.__changed = False
+        self.__reset_stats()
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with closing(sqlite3.connect(self.path)) as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version != SCHEMA_VERSION:
+                    logger.info(f"Merge cache {self.path} has schema {version}, rebuilding")
+                    return
+                for output_path, key, size, mtime_ns in conn.execute("SELECT output_path, key, size, mtime_ns FROM outputs"):
+                    self.outputs[output_path] = (key, size, mtime_ns)
+        except sqlite3.Error as e:
+            logger.warning(f"Ignoring unreadable merge cache {self.path}: {e}")
+            self.outputs = {}
+
+    def key(self, paths: Sequence[str], *params) -> str:
+        # paths is the base subtitle followed by the ones merged into it.
+        digest = hashlib.blake2b(digest_size=16)
+        for path in paths:
+            digest.update(self.__file_hash(path))
+        digest.update(repr((MERGE_VERSION,) + params).encode("utf-8"))
+        return digest.hexdigest()
+
+    def lookup(self, key: str, output_path: str) -> bool:
+        # True if output_path now holds the result for key, either because it
+        # is already there or because a stored result was copied into place.
+        record = self.outputs.get(output_path)
+        if record is not None and record[0] == key and self.__output_matches(output_path, record):
+            self.__count("hits")
+            return True
+
+        if record is not None and record[0] != key:
+            self.__count("stale")
+
+        result_path = self.__result_path(key)
+        if os.path.exists(result_path):
+            try:
+                self.__copy(result_path, output_path)
+            except OSError as e:
+                logger.warning(f"Could not reuse cached merge {result_path}: {e}")
+            else:
+                self.__remember(key, output_path)
+                self.__count("restored")
+                return True
+
+        self.__count("misses")
+        return False
+
+    def store(self, key: str, output_path: str) -> None:
+        result_path = self.__result_path(key)
+        if not os.path.exists(result_path):
+            os.makedirs(os.path.dirname(result_path), exist_ok=True)
+            self.__copy(output_path, result_path)
+        self.__remember(key, output_path)
+
+    def save(self) -> None:
+        if not self.__changed:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.executescript(
+                """
+                DROP TABLE IF EXISTS outputs;
+                CREATE TABLE outputs (output_path TEXT PRIMARY KEY, key TEXT, size INTEGER, mtime_ns INTEGER);
+                """
+            )
+            conn.executemany(
+                "INSERT INTO outputs VALUES (?, ?, ?, ?)",
+                ((path, key, size, mtime_ns) for path, (key, size, mtime_ns) in self.outputs.items()),
+            )
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.__changed = False
+
+    def prune(self) -> int:
+        # Forgets outputs that no longer exist and deletes every stored result
+        # no remaining output refers to. Returns how many results went.
+        with self.__lock:
+            for output_path in [path for path in self.outputs if not os.path.exists(path)]:
+                del self.outputs[output_path]
+                self.__changed = True
+            referenced = {key for key, _, _ in self.outputs.values()}
+
+        removed = 0
+        try:
+            prefixes = os.listdir(self.results_dir)
+        except FileNotFoundError:
+            return 0
+        for prefix in prefixes:
+            directory = os.path.join(self.results_dir, prefix)
+            for key in os.listdir(directory):
+                if key not in referenced:
+                    self.__unlink(os.path.join(directory, key))
+                    removed += 1
+        if removed:
+            logger.info(f"Pruned {removed} unused results from {self.results_dir}")
+        return removed
+
+    def clear(self) -> None:
+        self.outputs = {}
+        self.__changed = True
+        shutil.rmtree(self.results_dir, ignore_errors=True)
+
+    def __remember(self, key: str, output_path: str) -> None:
+        st = os.stat(output_path)
+        with self.__lock:
+            previous = self.outputs.get(output_path)
+            self.outputs[output_path] = (key, st.st_size, st.st_mtime_ns)
+            self.__changed = True
+            superseded = previous is not None and previous[0] != key and all(record[0] != previous[0] for record in self.outputs.values())
+        if superseded:
+            self.__unlink(self.__result_path(previous[0]))
+
+    def __unlink(self, path: str) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def __output_matches(self, output_path: str, record: OutputRecord) -> bool:
+        # The output is trusted if it is still the file we wrote; size and
+        # mtime are enough to notice it being edited or replaced.
+        try:
+            st = os.stat(output_path)
+        except FileNotFoundError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == record[1:]
+
+    def __result_path(self, key: str) -> str:
+        return os.path.join(self.results_dir, key[:2], key)
+
+    def __copy(self, source: str, target: str) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), prefix=".", suffix=".tmp")
+        os.close(fd)
+        try:
+            # copyfile keeps the temp file's owner-only mode.
+            os.chmod(tmp_path, FILE_MODE)
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def __file_hash(self, file_path: str) -> bytes:
+        with open(file_path, "rb") as file:
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped.
+                return hashlib.blake2b(b"", digest_size=16).digest()
+            with data:
+                return hashlib.blake2b(data, digest_size=16).digest()
+
+    def __count(self, name: str) -> None:
+        with self.__lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __reset_stats(self) -> None:
+        self.hits = self.restored = self.misses = self.stale = 0
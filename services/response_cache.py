@@ -0,0 +1,55 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# (body, etag)
+CachedResponse = Tuple[bytes, str]
+
+
+class ResponseCache:
+    # Serialized response bodies keyed by request, valid for one library
+    # generation. Any change to the library bumps its generation, and the first
+    # lookup under a new generation drops everything cached for the old one.
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.generation: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.__responses: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, generation: int, key: Hashable, render: Callable[[], bytes]) -> CachedResponse:
+        with self.__lock:
+            if generation != self.generation:
+                self.__responses.clear()
+                self.current_bytes = 0
+                self.generation = generation
+
+            cached = self.__responses.get(key)
+            if cached is not None:
+                self.__responses.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        body = render()
+        etag = f'"{generation}-{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+        with self.__lock:
+            if generation == self.generation and key not in self.__responses:
+                self.__responses[key] = (body, etag)
+                self.current_bytes += len(body)
+                while self.current_bytes > self.max_bytes and len(self.__responses) > 1:
+                    _, (evicted, _) = self.__responses.popitem(last=False)
+                    self.current_bytes -= len(evicted)
+        return body, etag
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__responses.clear()
+            self.current_bytes = 0
+            self.generation = None
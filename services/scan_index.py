@@ -0,0 +1,98 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Dict, Iterable, List, Optional, Tuple
+from utils.logger import logger
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "meedya")
+INDEX_FILE = "scan_index.sqlite3"
+SCHEMA_VERSION = 2
+
+# (mtime_ns, dirs, files)
+DirRecord = Tuple[int, List[str], List[str]]
+
+
+class ScanIndex:
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR) -> None:
+        self.path = os.path.join(cache_dir, INDEX_FILE)
+        self.dirs: Dict[str, DirRecord] = {}
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__seen_dirs: Dict[str, DirRecord] = {}
+
+    def clear(self) -> None:
+        self.dirs = {}
+        self.hits = self.misses = 0
+        self.__seen_dirs = {}
+
+    def load(self) -> None:
+        self.clear()
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with closing(sqlite3.connect(self.path)) as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version != SCHEMA_VERSION:
+                    logger.info(f"Scan index {self.path} has schema {version}, rebuilding")
+                    return
+                for path, mtime_ns, dirs, files in conn.execute("SELECT path, mtime_ns, dirs, files FROM directories"):
+                    self.dirs[path] = (mtime_ns, json.loads(dirs), json.loads(files))
+        except sqlite3.Error as e:
+            logger.warning(f"Ignoring unreadable scan index {self.path}: {e}")
+            self.dirs = {}
+
+        logger.info(f"Loaded scan index {self.path}: {len(self.dirs)} directories")
+
+    def get_dir(self, path: str, mtime_ns: int) -> Optional[DirRecord]:
+        record = self.dirs.get(path)
+        return self.__lookup(record if record and record[0] == mtime_ns else None)
+
+    def put_dir(self, path: str, record: DirRecord) -> None:
+        with self.__lock:
+            self.__seen_dirs[path] = record
+
+    def save(self, partial: bool = False) -> None:
+        # Everything seen by a full scan replaces the index, which also drops
+        # rows for directories that no longer exist. A partial scan (one show)
+        # only updates the rows it saw.
+        if partial:
+            self.__seen_dirs = {**self.dirs, **self.__seen_dirs}
+        unchanged = self.misses == 0 and self.__seen_dirs.keys() == self.dirs.keys()
+        if unchanged and os.path.exists(self.path):
+            self.__seen_dirs = {}
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.executescript(
+                """
+                DROP TABLE IF EXISTS directories;
+                DROP TABLE IF EXISTS subtitles;
+                CREATE TABLE directories (path TEXT PRIMARY KEY, mtime_ns INTEGER, dirs TEXT, files TEXT);
+                """
+            )
+            conn.executemany(
+                "INSERT INTO directories VALUES (?, ?, ?, ?)",
+                self.__dir_rows(self.__seen_dirs.items()),
+            )
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        self.dirs = self.__seen_dirs
+        self.__seen_dirs = {}
+        logger.info(f"Saved scan index {self.path}: {self.hits} reused, {self.misses} rescanned")
+
+    def __lookup(self, record):
+        with self.__lock:
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return record
+
+    def __dir_rows(self, items: Iterable[Tuple[str, DirRecord]]):
+        for path, (mtime_ns, dirs, files) in items:
+            yield path, mtime_ns, json.dumps(dirs, ensure_ascii=False), json.dumps(files, ensure_ascii=False)
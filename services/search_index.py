@@ -0,0 +1,330 @@
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from models.media_item import Library, Season
+from models.search import SearchHit
+from models.subtitle_track import SubtitleTrack
+from services.batch_merger import COMBINED_TAG
+from services.scan_index import DEFAULT_CACHE_DIR
+from services.subtitle_cache import SubtitleCache, subtitle_cache
+from utils.logger import logger
+
+INDEX_FILE = "search_index.sqlite3"
+SCHEMA_VERSION = 2
+
+# Formatting tags (<i>, {\an8}) are not dialogue.
+TAG_RE = re.compile(r"<[^>]*>|\{[^}]*\}")
+# Words, plus each CJK character on its own, since Chinese and Japanese text
+# has no spaces to split on.
+TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]|[^\W_]+")
+
+# Files parsed and written per transaction while syncing.
+SYNC_CHUNK = 64
+# Paths looked up per query in a targeted sync (SQLite's default limit on
+# bound parameters is 999).
+LOOKUP_CHUNK = 500
+
+# (folder, name, show, season, language) of the episode or movie a subtitle
+# belongs to; folder is the top-level folder a partial rescan covers.
+Owner = Tuple[str, str, Optional[str], Optional[str], Optional[str]]
+
+
+def tokenize(text: str) -> List[str]:
+    return [token.lower() for token in TOKEN_RE.findall(TAG_RE.sub(" ", text))]
+
+
+class SearchIndex:
+    # Inverted index from dialogue tokens to the cues they appear in, kept in
+    # SQLite next to the scan index. Each subtitle is stored with its size
+    # and mtime, so syncing with a library only re-parses files that changed.
+    # Postings are one row per token and file, holding the positions of the
+    # cues that contain it, and a file's cues are stored as one compressed
+    # row, so the index stays a fraction of the size of the subtitles.
+    def __init__(self, cache: SubtitleCache = subtitle_cache, cache_dir: str = DEFAULT_CACHE_DIR, max_workers: Optional[int] = None) -> None:
+        self.cache = cache
+        self.path = os.path.join(cache_dir, INDEX_FILE)
+        self.max_workers = max_workers
+        self.__lock = threading.Lock()
+        self.__ready = False
+
+    def sync(self, library: Library, scope: Optional[str] = None) -> None:
+        # Brings the index in line with the library's subtitles. A scoped sync
+        # (one rescanned show or movie) only drops files from that folder.
+        owners = dict(self.__subtitles(library))
+        with self.__lock, closing(self.__connect()) as conn:
+            known = {
+                path: (file_id, size, mtime_ns, folder)
+                for file_id, path, size, mtime_ns, folder in conn.execute("SELECT id, path, size, mtime_ns, folder FROM files")
+            }
+            removed = [
+                record[0] for path, record in known.items()
+                if path not in owners and (scope is None or record[3] == scope)
+            ]
+            self.__update(conn, owners, known, removed)
+
+    def sync_paths(self, owners: Dict[str, Optional[Owner]]) -> None:
+        # Brings just these subtitles in line, for targeted updates (the
+        # watcher): only they are statted and looked up, so the cost follows
+        # the size of the change rather than of the library. A None owner
+        # marks a path that has left the library.
+        if not owners:
+            return
+        paths = list(owners)
+        with self.__lock, closing(self.__connect()) as conn:
+            known = {}
+            for i in range(0, len(paths), LOOKUP_CHUNK):
+                chunk = paths[i:i + LOOKUP_CHUNK]
+                rows = conn.execute(
+                    f"SELECT id, path, size, mtime_ns, folder FROM files WHERE path IN ({', '.join('?' for _ in chunk)})", chunk,
+                )
+                known.update((path, (file_id, size, mtime_ns, folder)) for file_id, path, size, mtime_ns, folder in rows)
+            current = {path: owner for path, owner in owners.items() if owner is not None}
+            removed = [known[path][0] for path, owner in owners.items() if owner is None and path in known]
+            self.__update(conn, current, known, removed)
+
+    def season_subtitles(self, show: str, season: Season) -> Iterator[Tuple[str, Owner]]:
+        # Combined files repeat the text of the pairs they were merged from.
+        for episode in season.episodes:
+            for subtitle in episode.subtitles:
+                if COMBINED_TAG not in os.path.basename(subtitle.file_path):
+                    yield subtitle.file_path, (show, episode.name, show, season.name, subtitle.language)
+
+    def __update(self, conn: sqlite3.Connection, owners: Dict[str, Owner], known: Dict[str, Tuple[int, int, int, str]], removed: List[int]) -> None:
+        # Re-indexes the subtitles in owners whose size or mtime differ from
+        # the known rows, and drops the removed file ids.
+        changed: List[Tuple[str, int, int]] = []
+        for path in owners:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            record = known.get(path)
+            if record is None or record[1:3] != (st.st_size, st.st_mtime_ns):
+                changed.append((path, st.st_size, st.st_mtime_ns))
+
+        with conn:
+            for file_id in removed + [known[path][0] for path, _, _ in changed if path in known]:
+                self.__delete_file(conn, file_id)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for i in range(0, len(changed), SYNC_CHUNK):
+                chunk = changed[i:i + SYNC_CHUNK]
+                tracks = pool.map(self.__parse, [path for path, _, _ in chunk])
+                with conn:
+                    for (path, size, mtime_ns), track in zip(chunk, tracks):
+                        if track is not None:
+                            self.__insert_file(conn, path, size, mtime_ns, owners[path], track)
+
+        if changed or removed:
+            logger.info(f"Search index: {len(changed)} subtitles indexed, {len(removed)} removed")
+
+    def search(self, query: str, limit: int = 20) -> List[SearchHit]:
+        # Cues are ranked by how many of the query's words they contain, each
+        # weighted by rarity (idf), with a bonus when the words appear
+        # together in order. Candidates are gathered from the rarest word
+        # first, and once there are limit * 5 of them the commoner words are
+        # only looked up in the files already holding a candidate, so a query
+        # with a word in every subtitle does not read all of its postings.
+        terms = tokenize(query)
+        tokens = list(dict.fromkeys(terms))
+        if not tokens or not os.path.exists(self.path):
+            return []
+
+        with closing(self.__connect()) as conn:
+            total = conn.execute("SELECT COALESCE(SUM(cue_count), 0) FROM files").fetchone()[0]
+            weights = []
+            for token in tokens:
+                df = conn.execute("SELECT COALESCE(SUM(LENGTH(positions)), 0) FROM postings WHERE token = ?", (token,)).fetchone()[0] // 4
+                if df:
+                    weights.append((df, token, math.log(1 + total / df)))
+            if not weights:
+                return []
+            weights.sort()
+
+            capacity = limit * 5
+            # (file_id, position) -> [words matched, summed weight]
+            scores: Dict[Tuple[int, int], List[float]] = {}
+            files: Set[int] = set()
+            for _, token, weight in weights:
+                known = sorted(files)
+                for i in range(0, len(known), LOOKUP_CHUNK):
+                    chunk = known[i:i + LOOKUP_CHUNK]
+                    rows = conn.execute(
+                        f"SELECT file_id, positions FROM postings WHERE token = ? AND file_id IN ({', '.join('?' for _ in chunk)})", [token] + chunk,
+                    )
+                    self.__score(scores, rows, weight, admit=False)
+                if len(scores) < capacity:
+                    scored = set(files)
+                    for file_id, positions in conn.execute("SELECT file_id, positions FROM postings WHERE token = ?", (token,)):
+                        if file_id in scored:
+                            continue
+                        self.__score(scores, [(file_id, positions)], weight, admit=True)
+                        files.add(file_id)
+                        if len(scores) >= capacity:
+                            break
+
+            candidates = sorted(scores.items(), key=lambda item: (-item[1][0], -item[1][1]))[:capacity]
+            phrase = f" {' '.join(terms)} "
+            bonus = sum(weight for _, _, weight in weights)
+            # Texts are only decompressed for the phrase check, which needs
+            # every word, and for the hits returned.
+            files_cues: Dict[int, Tuple] = {}
+            texts: Dict[int, List[str]] = {}
+            ranked = []
+            for (file_id, position), (matched, score) in candidates:
+                if file_id not in files_cues:
+                    files_cues[file_id] = self.__load_cues(conn, file_id)
+                score *= matched / len(tokens)
+                if len(terms) > 1 and matched == len(tokens):
+                    if file_id not in texts:
+                        texts[file_id] = self.__load_texts(conn, file_id)
+                    if phrase in f" {' '.join(tokenize(texts[file_id][position]))} ":
+                        score += bonus
+                ranked.append((-score, files_cues[file_id][3], files_cues[file_id][6][position], file_id, position))
+            ranked.sort()
+
+            hits = []
+            for score, _, _, file_id, position in ranked[:limit]:
+                name, show, season, path, language, indexes, starts, ends = files_cues[file_id]
+                if file_id not in texts:
+                    texts[file_id] = self.__load_texts(conn, file_id)
+                hits.append(SearchHit(
+                    name=name, show=show, season=season, file_path=path, language=language,
+                    cue=indexes[position], start_ms=starts[position], end_ms=ends[position], text=texts[file_id][position], score=round(-score, 4),
+                ))
+
+        return hits
+
+    def clear(self) -> None:
+        with self.__lock:
+            for path in (self.path, f"{self.path}-wal", f"{self.path}-shm"):
+                if os.path.exists(path):
+                    os.unlink(path)
+            self.__ready = False
+
+    def __subtitles(self, library: Library) -> Iterator[Tuple[str, Owner]]:
+        for tv_show in library.tv_shows:
+            for season in tv_show.seasons:
+                yield from self.season_subtitles(tv_show.name, season)
+        for movie in library.movies:
+            for subtitle in movie.subtitles:
+                if COMBINED_TAG not in os.path.basename(subtitle.file_path):
+                    yield subtitle.file_path, (movie.name, movie.name, None, None, subtitle.language)
+
+    def __parse(self, path: str) -> Optional[SubtitleTrack]:
+        try:
+            return self.cache.get_file(path)
+        except Exception as e:
+            logger.warning(f"Not indexing {path}: {e}")
+            return None
+
+    def __insert_file(self, conn: sqlite3.Connection, path: str, size: int, mtime_ns: int, owner: Owner, track: SubtitleTrack) -> None:
+        folder, name, show, season, language = owner
+        file_id = conn.execute(
+            "INSERT INTO files (path, size, mtime_ns, folder, name, show, season, language, cue_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, size, mtime_ns, folder, name, show, season, language, len(track)),
+        ).lastrowid
+
+        texts = list(track.texts())
+        postings: Dict[str, array] = {}
+        for position, text in enumerate(texts):
+            for token in dict.fromkeys(tokenize(text)):
+                positions = postings.get(token)
+                if positions is None:
+                    positions = postings[token] = array("i")
+                positions.append(position)
+
+        conn.execute(
+            "INSERT INTO file_cues VALUES (?, ?, ?, ?, ?)",
+            (file_id, track.indexes.tobytes(), track.starts.tobytes(), track.ends.tobytes(), zlib.compress(json.dumps(texts, ensure_ascii=False).encode("utf-8"))),
+        )
+        conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", ((token, file_id, positions.tobytes()) for token, positions in postings.items()))
+
+    def __delete_file(self, conn: sqlite3.Connection, file_id: int) -> None:
+        # The file's tokens come from its stored texts, so its postings are
+        # found through the primary key without a second index by file.
+        row = conn.execute("SELECT texts FROM file_cues WHERE file_id = ?", (file_id,)).fetchone()
+        if row is not None:
+            tokens = dict.fromkeys(token for text in self.__texts(row[0]) for token in tokenize(text))
+            conn.executemany("DELETE FROM postings WHERE token = ? AND file_id = ?", ((token, file_id) for token in tokens))
+        conn.execute("DELETE FROM file_cues WHERE file_id = ?", (file_id,))
+        conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    def __load_cues(self, conn: sqlite3.Connection, file_id: int) -> Tuple:
+        name, show, season, path, language, indexes, starts, ends = conn.execute(
+            """
+            SELECT f.name, f.show, f.season, f.path, f.language, c.indexes, c.starts, c.ends
+            FROM file_cues c JOIN files f ON f.id = c.file_id
+            WHERE c.file_id = ?
+            """,
+            (file_id,),
+        ).fetchone()
+        return name, show, season, path, language, array("i", indexes), array("i", starts), array("i", ends)
+
+    def __load_texts(self, conn: sqlite3.Connection, file_id: int) -> List[str]:
+        return self.__texts(conn.execute("SELECT texts FROM file_cues WHERE file_id = ?", (file_id,)).fetchone()[0])
+
+    @staticmethod
+    def __texts(blob: bytes) -> List[str]:
+        return json.loads(zlib.decompress(blob))
+
+    @staticmethod
+    def __score(scores: Dict[Tuple[int, int], List[float]], rows: Iterable[Tuple[int, bytes]], weight: float, admit: bool) -> None:
+        # Adds a word to the cues listed in its posting rows; with admit=False
+        # only to cues that are already candidates.
+        for file_id, positions in rows:
+            for position in array("i", positions):
+                score = scores.get((file_id, position))
+                if score is None:
+                    if not admit:
+                        continue
+                    score = scores[(file_id, position)] = [0, 0.0]
+                score[0] += 1
+                score[1] += weight
+
+    def __connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        if not self.__ready:
+            self.__create_schema(conn)
+            self.__ready = True
+        return conn
+
+    def __create_schema(self, conn: sqlite3.Connection) -> None:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        if version:
+            logger.info(f"Search index {self.path} has schema {version}, rebuilding")
+
+        # WAL lets searches read while a sync is writing.
+        conn.execute("PRAGMA journal_mode = WAL")
+        with conn:
+            conn.executescript(
+                """
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS cues;
+                DROP TABLE IF EXISTS postings;
+                CREATE TABLE files (
+                    id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime_ns INTEGER,
+                    folder TEXT, name TEXT, show TEXT, season TEXT, language TEXT, cue_count INTEGER
+                );
+                DROP TABLE IF EXISTS file_cues;
+                CREATE TABLE file_cues (
+                    file_id INTEGER PRIMARY KEY, indexes BLOB, starts BLOB, ends BLOB, texts BLOB
+                );
+                CREATE TABLE postings (
+                    token TEXT, file_id INTEGER, positions BLOB,
+                    PRIMARY KEY (token, file_id)
+                ) WITHOUT ROWID;
+                """
+            )
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
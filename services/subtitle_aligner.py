@@ -0,0 +1,143 @@
+from bisect import bisect_left, bisect_right
+from enum import Enum
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from models.subtitle_track import SubtitleTrack
+
+
+class AlignMode(str, Enum):
+    TOLERANCE = "tolerance"
+    OVERLAP = "overlap"
+    DRIFT = "drift"  # overlap after correcting offset and framerate; needs numpy
+
+
+# Cues shorter than 2 ** 13 ms (about 8 seconds), which is most dialogue, share
+# one duration class; longer ones go in classes each 8 times longer than the
+# last.
+SHORT_CUE_BITS = 13
+
+
+class DurationClass(NamedTuple):
+    # Cues of similar length, sorted by start, and the longest of them.
+    max_duration: int
+    starts: List[int]
+    start_order: List[Tuple[int, int]]
+
+
+class CueIndex:
+    # Start/end times of a cue list parsed once into integer milliseconds, with
+    # views sorted by start and by end for binary search, and the cues sorted
+    # by start again within each duration class.
+    def __init__(self, spans: Sequence[Optional[Tuple[int, int]]]) -> None:
+        valid = [(span[0], span[1], i) for i, span in enumerate(spans) if span is not None]
+
+        by_start = sorted(valid)
+        self.starts = [start for start, _, _ in by_start]
+        self.start_order = [(end, i) for _, end, i in by_start]
+
+        by_end = sorted((end, start, i) for start, end, i in valid)
+        self.ends = [end for end, _, _ in by_end]
+        self.end_order = [i for _, _, i in by_end]
+
+        classes: Dict[int, List[Tuple[int, int, int]]] = {}
+        for start, end, i in by_start:
+            classes.setdefault(((end - start) >> SHORT_CUE_BITS).bit_length() // 3, []).append((start, end, i))
+        self.duration_classes = [
+            DurationClass(
+                max(end - start for start, end, _ in cues),
+                [start for start, _, _ in cues],
+                [(end, i) for _, end, i in cues],
+            )
+            for cues in classes.values()
+        ]
+
+    @classmethod
+    def from_track(cls, track: SubtitleTrack) -> "CueIndex":
+        return cls(track.spans())
+
+
+class SubtitleAligner:
+    def __init__(self, mode: AlignMode = AlignMode.TOLERANCE, tolerance: float = 1) -> None:
+        self.mode = AlignMode(mode)
+        self.tolerance_ms = int(round(tolerance * 1000))
+        self.drift_aligner = None
+        if self.mode is AlignMode.DRIFT:
+            # Imported here so numpy is only needed when this mode is used.
+            from services.drift_aligner import DriftAligner
+            self.drift_aligner = DriftAligner()
+
+    def align(self, base_track: SubtitleTrack, merge_track: SubtitleTrack) -> List[Optional[int]]:
+        if self.drift_aligner is not None:
+            return self.drift_aligner.align(base_track, merge_track)
+        return self.align_spans(base_track.spans(), CueIndex.from_track(merge_track))
+
+    def align_all(self, base_track: SubtitleTrack, tracks: Sequence[SubtitleTrack]) -> List[List[Optional[int]]]:
+        # Matches for several tracks at once, one list per track. Each track is
+        # indexed once and the base cues are walked a single time, looking
+        # each one up in every index.
+        if self.drift_aligner is not None:
+            # Offset and drift are estimated per track, on whole arrays.
+            return [self.drift_aligner.align(base_track, track) for track in tracks]
+
+        match = self.__matcher()
+        indexes = [CueIndex.from_track(track) for track in tracks]
+        columns: List[List[Optional[int]]] = [[] for _ in tracks]
+        for span in base_track.spans():
+            for column, index in zip(columns, indexes):
+                column.append(match(span, index))
+        return columns
+
+    def align_spans(self, base_spans: Sequence[Optional[Tuple[int, int]]], index: CueIndex) -> List[Optional[int]]:
+        match = self.__matcher()
+        return [match(span, index) if span is not None else None for span in base_spans]
+
+    def __matcher(self):
+        # Drift mode needs both whole tracks, so spans on their own fall back to
+        # plain overlap matching.
+        if self.mode in (AlignMode.OVERLAP, AlignMode.DRIFT):
+            return self.__match_overlap
+        return self.__match_tolerance
+
+    def __match_tolerance(self, span: Tuple[int, int], index: CueIndex) -> Optional[int]:
+        # Same rule as the original linear scan: the earliest cue (in file order)
+        # whose start or end lies within the tolerance of the base cue.
+        start, end = span
+        tol = self.tolerance_ms
+        best: Optional[int] = None
+
+        lo = bisect_left(index.starts, start - tol)
+        hi = bisect_right(index.starts, start + tol)
+        for k in range(lo, hi):
+            i = index.start_order[k][1]
+            if best is None or i < best:
+                best = i
+
+        lo = bisect_left(index.ends, end - tol)
+        hi = bisect_right(index.ends, end + tol)
+        for k in range(lo, hi):
+            i = index.end_order[k]
+            if best is None or i < best:
+                best = i
+
+        return best
+
+    def __match_overlap(self, span: Tuple[int, int], index: CueIndex) -> Optional[int]:
+        # The cue sharing the most screen time with the base cue. Only cues that
+        # start before the base cue ends, and no earlier than the longest cue
+        # of their duration class could still reach it, need to be looked at.
+        # Bounding each class by its own longest cue keeps one long cue from
+        # widening the scan over all the short ones.
+        start, end = span
+        best: Optional[int] = None
+        best_overlap = 0
+
+        for duration_class in index.duration_classes:
+            starts = duration_class.starts
+            hi = bisect_left(starts, end)
+            lo = bisect_left(starts, start - duration_class.max_duration)
+            for k in range(lo, hi):
+                cue_end, i = duration_class.start_order[k]
+                overlap = min(end, cue_end) - max(start, starts[k])
+                if overlap > best_overlap or (overlap == best_overlap and best is not None and i < best):
+                    best, best_overlap = i, overlap
+
+        return best
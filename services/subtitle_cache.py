@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Tuple
+from models.subtitle import Subtitle
+from models.subtitle_track import SubtitleTrack
+from services.subtitle_parser import SubtitleParser
+from utils.logger import logger
+
+DEFAULT_BUDGET_MB = 256
+
+# (path, size, mtime_ns)
+CacheKey = Tuple[str, int, int]
+
+
+class SubtitleCache:
+    # The one place subtitle files are parsed: the models, the search index,
+    # batch merges and the cue API all go through here, keyed by path, size
+    # and mtime, so a scan + merge + serve run reads each file once while it
+    # stays in the budget, and an edited file is never served stale.
+    def __init__(self, parser: SubtitleParser, max_bytes: int) -> None:
+        self.parser = parser
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__tracks: "OrderedDict[CacheKey, Tuple[SubtitleTrack, int]]" = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, subtitle: Subtitle) -> SubtitleTrack:
+        return self.get_file(subtitle.file_path)
+
+    def get_file(self, file_path: str, store: bool = True) -> SubtitleTrack:
+        # With store=False a cached track is still used, but a parsed one is
+        # not kept, for callers that only need each file once (batch workers).
+        key = self.__key(file_path)
+        with self.__lock:
+            cached = self.__tracks.get(key)
+            if cached is not None:
+                self.__tracks.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        track = self.parser.parse_track(file_path)
+        if not store:
+            return track
+        cost = track.nbytes
+
+        with self.__lock:
+            if key not in self.__tracks:
+                # Earlier versions of the file are of no further use.
+                self.__drop(file_path)
+                self.__tracks[key] = (track, cost)
+                self.current_bytes += cost
+            self.__evict()
+        return track
+
+    def contains(self, subtitle: Subtitle) -> bool:
+        try:
+            key = self.__key(subtitle.file_path)
+        except FileNotFoundError:
+            return False
+        with self.__lock:
+            return key in self.__tracks
+
+    def invalidate(self, file_path: str) -> None:
+        with self.__lock:
+            self.__drop(file_path)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__tracks.clear()
+            self.current_bytes = 0
+
+    def __drop(self, file_path: str) -> None:
+        for key in [key for key in self.__tracks if key[0] == file_path]:
+            self.current_bytes -= self.__tracks.pop(key)[1]
+
+    def __evict(self) -> None:
+        # Always keep the most recently used subtitle, even if it alone is over
+        # budget, so the caller's track stays valid.
+        while self.current_bytes > self.max_bytes and len(self.__tracks) > 1:
+            key, (_, cost) = self.__tracks.popitem(last=False)
+            self.current_bytes -= cost
+            logger.debug(f"Evicted {key[0]} from subtitle cache")
+
+    def __key(self, file_path: str) -> CacheKey:
+        st = os.stat(file_path)
+        return file_path, st.st_size, st.st_mtime_ns
+
+
+subtitle_cache = SubtitleCache(
+    SubtitleParser(),
+    max_bytes=int(os.environ.get("MEEDYA_SUBTITLE_CACHE_MB", DEFAULT_BUDGET_MB)) * 1024 * 1024,
+)
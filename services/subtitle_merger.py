@@ -1,71 +1,83 @@
-from typing import Dict, Any, List, Optional
-from models.subtitle import Subtitle,SubtitleEntry
+import logging
+import time
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence
+from models.subtitle import Subtitle
+from models.subtitle_track import Cue, SubtitleTrack
+from services.subtitle_aligner import AlignMode, SubtitleAligner
+from services.subtitle_writer import SubtitleWriter
+from utils.instrumentation import counters
 from utils.logger import logger  
+from utils.metrics import stage_seconds
+
+if TYPE_CHECKING:
+    from services.timing_repair import TimingRepair
 
 class SubtitleMerger:
-    def __init__(self):
+    # With a TimingRepair, merged cues are repaired before they are written
+    # and a merge cue matched to several base cues in a row is shown once.
+    def __init__(self, aligner: Optional[SubtitleAligner] = None, repair: Optional["TimingRepair"] = None):
+        self.aligner = aligner or SubtitleAligner(mode=AlignMode.TOLERANCE, tolerance=1)
+        self.repair = repair
         logger.info("SubtitleMerger initialized")
 
-    def merge(self, base_subtitle: Subtitle, merge_subtitle: Subtitle) -> None:
-        logger.info(f"Starting merge: base={base_subtitle.file_path}, merge={merge_subtitle.file_path}")
-
-        new_subtitle = Subtitle(file_path="", format="srt", language="combined")
-
-        base_entries = base_subtitle.entries
-        merge_entries = merge_subtitle.entries
-
-        new_entries = []
-        for i in range(len(base_entries)):
-            subtitle = base_entries[i]
-            nearest_subtitle = self.__find_closest_subtitle(subtitle, merge_entries)
-
-            if nearest_subtitle:
-                nearest_subtitle_index = merge_entries.index(nearest_subtitle)
-                if nearest_subtitle_index > len(merge_entries) - 1:
-                    logger.warning(f"No matching subtitle for timestamp {subtitle['timestamp']} in {merge_subtitle.file_path}")
-                    new_text = subtitle.text
-                else:
-                    new_text = f"{subtitle.text}\n{nearest_subtitle.text}"
-            else:
-                logger.debug(f"No close subtitle found for base entry index {i} timestamp {subtitle['timestamp']}")
-                new_text = subtitle["text"]
-
+    def merge(self, base_subtitle: Subtitle, merge_subtitle: Subtitle, format: str = "srt") -> None:
+        self.merge_all(base_subtitle, [merge_subtitle], format)
 
+    def merge_all(self, base_subtitle: Subtitle, merge_subtitles: Sequence[Subtitle], format: str = "srt") -> None:
+        logger.info(f"Starting merge: base={base_subtitle.file_path}, merge={', '.join(s.file_path for s in merge_subtitles)}")
 
-            entry=SubtitleEntry(index=i+1,timestamp=subtitle['timestamp'],text=new_text)
-
-            new_entries.append(entry)
-
-        new_subtitle.entries = new_entries
-
-        output_file = base_subtitle.file_path.rsplit('.', 1)[0] + '_combined.srt'
+        output_file = self.output_path(base_subtitle.file_path, format)
         logger.info(f"Saving merged subtitle to {output_file}")
-        new_subtitle.save(output_file)
+        cues = self.iter_merged_all(base_subtitle.track, [s.track for s in merge_subtitles], base_subtitle.file_path)
+        SubtitleWriter(format).write(output_file, cues)
         logger.info("Merge completed successfully")
 
-    def __find_closest_subtitle(self, base_subtitle_entry: SubtitleEntry, target_subtitle_entries: List, tolerance: int = 1) -> Optional[SubtitleEntry]:
-        for entry in target_subtitle_entries:
-            if entry["timestamp"].startswith(base_subtitle_entry.timestamp):
-                logger.debug(f"Exact timestamp match found: {entry['timestamp']}")
-                return entry
-            start_time, end_time = base_subtitle_entry.timestamp.split(' --> ')
-            start_time_seconds = self.__timestamp_to_seconds(start_time)
-            end_time_seconds = self.__timestamp_to_seconds(end_time)
-
-            target_start_time, target_end_time = entry["timestamp"].split(' --> ')
-            target_start_seconds = self.__timestamp_to_seconds(target_start_time)
-            target_end_seconds = self.__timestamp_to_seconds(target_end_time)
-
-            if abs(target_start_seconds - start_time_seconds) <= tolerance or abs(target_end_seconds - end_time_seconds) <= tolerance:
-                logger.debug(f"Close timestamp match found within tolerance: base {base_subtitle_entry.timestamp}, target {entry['timestamp']}")
-                return entry
+    def output_path(self, base_path: str, format: str = "srt") -> str:
+        return base_path.rsplit('.', 1)[0] + f'_combined.{format}'
+
+    def merge_tracks(self, base_track: SubtitleTrack, merge_track: SubtitleTrack, base_path: str = "") -> SubtitleTrack:
+        new_track = SubtitleTrack()
+        new_track.extend(self.iter_merged(base_track, merge_track, base_path))
+        return new_track
+
+    def iter_merged(self, base_track: SubtitleTrack, merge_track: SubtitleTrack, base_path: str = "") -> Iterator[Cue]:
+        return self.iter_merged_all(base_track, [merge_track], base_path)
+
+    def iter_merged_all(self, base_track: SubtitleTrack, merge_tracks: Sequence[SubtitleTrack], base_path: str = "") -> Iterator[Cue]:
+        # Merged cues one at a time, so they can go straight to a writer
+        # without building a merged track first. Matched text from each merge
+        # track is appended below the base text, in the order given. The
+        # alignment runs here rather than on the first cue, so its time is not
+        # counted as the writer's. Repair needs every merged cue, so it runs
+        # here too and the merged file is then held in memory.
+        started = time.perf_counter()
+        columns = self.aligner.align_all(base_track, merge_tracks)
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage="align")
+        counters.add(base_path, align_ms=round(elapsed * 1000))
+        if self.repair is None:
+            return self.__iter_merged(base_track, merge_tracks, columns, None, base_path)
+
+        repeated = self.repair.repeats(columns) if self.repair.options.dedupe else None
+        return iter(self.repair.repair_cues(self.__iter_merged(base_track, merge_tracks, columns, repeated, base_path), base_path))
+
+    def __iter_merged(self, base_track: SubtitleTrack, merge_tracks: Sequence[SubtitleTrack], columns: List[List[Optional[int]]], repeated: Optional[Sequence[Sequence[bool]]], base_path: str) -> Iterator[Cue]:
+        debug = logger.isEnabledFor(logging.DEBUG)
+        matches = misses = 0
+        for i, (start, end, text) in enumerate(zip(base_track.starts, base_track.ends, base_track.texts())):
+            lines: List[str] = [text]
+            for k, (track, column) in enumerate(zip(merge_tracks, columns)):
+                match = column[i]
+                if match is not None:
+                    matches += 1
+                    if repeated is None or not repeated[k][i]:
+                        lines.append(track.text(match))
+                else:
+                    misses += 1
+                    if debug:
+                        logger.debug("No close subtitle found for base entry index %d at %dms", i, start)
 
-        logger.debug(f"No close subtitle found for timestamp {base_subtitle_entry.timestamp}")
-        return None
+            yield i + 1, start, end, "\n".join(lines)
 
-    def __timestamp_to_seconds(self, timestamp: str) -> float:
-        h, m, s_ms = timestamp.split(":")
-        s, ms = s_ms.split(",")
-        total_seconds = int(h) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000
-        logger.debug(f"Converted timestamp {timestamp} to seconds: {total_seconds}")
-        return total_seconds
+        counters.add(base_path, merges=1, matches=matches, misses=misses)
+        logger.debug("Merged %s: %d matched, %d unmatched", base_path, matches, misses)
@@ -1,63 +1,143 @@
-from typing import List, Tuple
+import codecs
+import mmap
+import re
+import time
+from typing import Iterator, Optional, Sequence, Tuple
 from models.subtitle import Subtitle
-from models.subtitle import SubtitleEntry
+from models.subtitle_track import Cue, SubtitleTrack
+from utils.instrumentation import counters
 from utils.logger import logger  # your custom logger import
+from utils.metrics import stage_seconds
+from utils.timestamp import parse_timing
+
+BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# Tried in order when the file has no BOM. Strict UTF-8 rejects most legacy
+# text, GB2312 covers the Chinese releases in the library and cp1252 the
+# Western ones. GB2312 rather than GBK/GB18030, because those also accept an
+# accented Latin letter followed by ASCII as a valid double-byte character.
+DEFAULT_ENCODINGS = ("utf-8", "gb2312", "cp1252")
+
+# A block is a run of non-blank lines.
+BLOCK_RE = re.compile(r"[^\n]*\S[^\n]*(?:\n[^\n]*\S[^\n]*)*")
+LINE_BREAKS_RE = re.compile(r"\r\n?")
 
 class SubtitleParser:
 
-    def __init__(self):
-        logger.info("SubtitleParser initialized")
-    
+    def __init__(self, encodings: Sequence[str] = DEFAULT_ENCODINGS):
+        self.encodings = tuple(encodings)
+        logger.debug("SubtitleParser initialized")
+
     def parse_srt_file(self, file_path: str) -> Subtitle:
-        logger.info(f"Parsing SRT file: {file_path}")
+        subtitle = Subtitle(file_path=file_path, format='srt')
+        subtitle.track = self.parse_track(file_path)
+        return subtitle
+
+    def parse_track(self, file_path: str) -> SubtitleTrack:
+        logger.debug("Parsing SRT file: %s", file_path)
+        started = time.perf_counter()
+        track = SubtitleTrack()
+        track.extend(self.iter_cues(file_path))
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage="parse")
+        counters.add(file_path, files_parsed=1, cues_parsed=len(track), parse_ms=round(elapsed * 1000))
+        logger.debug("Completed parsing '%s', total entries: %d", file_path, len(track))
+        return track
+
+    def iter_cues(self, file_path: str) -> Iterator[Cue]:
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                file_array = file.readlines()
+            text = self.__read_text(file_path)
         except Exception as e:
             logger.error(f"Failed to read file '{file_path}': {e}")
             raise
-        
-        indexes, timestamps, subtitles = self.__extract_subtitles(file_array)
-        logger.debug(f"Extracted {len(indexes)} indexes, {len(timestamps)} timestamps, and {len(subtitles)} subtitles")
-        
-        entries = []
-        for i in range(len(indexes)):
-            entry=SubtitleEntry(index=indexes[i],timestamp=timestamps[i] if i < len(timestamps) else '',text=subtitles[i] if i < len(subtitles) else '')
-            entries.append(entry)
-        
-        subtitle = Subtitle(file_path=file_path, format='srt')
-        subtitle.entries = entries
-        logger.info(f"Completed parsing '{file_path}', total entries: {len(entries)}")
-        return subtitle
-    
-    def __extract_subtitles(self, file_array: List[str]) -> Tuple[List[int], List[str], List[str]]:
-        indexes = []
-        timestamps = []
-        subtitles = []
-        current_subtitle = []
-        
-        logger.debug("Beginning subtitle extraction from file lines")
-        for line in file_array:
-            line = line.strip()
-            if not line:
+
+        return self.iter_text_cues(text, file_path)
+
+    def iter_text_cues(self, text: str, source: str = "<text>") -> Iterator[Cue]:
+        # Each block is an optional cue number, a timing line, then text up to
+        # the next blank line. The timing line is found by position, so a text
+        # line that is just a number is never mistaken for a cue number. A
+        # block without a timing line is text that contained a blank line and
+        # belongs to the previous cue, which is why cues are yielded one block
+        # late, unless it starts with a cue number: then it is a cue whose
+        # timestamp is missing, and it is dropped.
+        text = LINE_BREAKS_RE.sub("\n", text)
+        pending: Optional[Cue] = None
+        last_index = 0
+
+        for match in BLOCK_RE.finditer(text):
+            lines = match.group().split("\n")
+            timing_line, timing = self.__find_timing_line(lines)
+
+            if timing is None:
+                if pending is not None and not lines[0].strip().isdigit():
+                    index, start, end, cue_text = pending
+                    extra = "\n".join(line.strip() for line in lines)
+                    pending = (index, start, end, f"{cue_text}\n\n{extra}" if cue_text else extra)
+                else:
+                    counters.add(source, blocks_skipped=1)
+                    logger.debug("Skipping block without a timestamp in '%s' at offset %d", source, match.start())
                 continue
-            if line.isdigit():
-                if current_subtitle:
-                    subtitles.append('\n'.join(current_subtitle))
-                    logger.debug(f"Added subtitle block: {subtitles[-1][:30]}...")
-                    current_subtitle = []
-                indexes.append(int(line))
-                logger.debug(f"Found subtitle index: {line}")
-            elif '-->' in line:
-                timestamps.append(line)
-                logger.debug(f"Found timestamp line: {line}")
-            else:
-                current_subtitle.append(line)
-        
-        if current_subtitle:
-            subtitles.append('\n'.join(current_subtitle))
-            logger.debug(f"Added final subtitle block: {subtitles[-1][:30]}...")
-        
-        logger.debug(f"Extraction done: {len(indexes)} indexes, {len(timestamps)} timestamps, {len(subtitles)} subtitle blocks")
-        return indexes, timestamps, subtitles
 
+            number = lines[0].strip() if timing_line == 1 else ""
+            index = int(number) if number.isdigit() else last_index + 1
+            last_index = index
+
+            start, end = timing
+            cue_text = "\n".join(line.strip() for line in lines[timing_line + 1:])
+
+            if pending is not None:
+                yield pending
+            pending = (index, start, end, cue_text)
+
+        if pending is not None:
+            yield pending
+
+    def __find_timing_line(self, lines: Sequence[str]) -> Tuple[int, Optional[Tuple[int, int]]]:
+        for i in range(min(2, len(lines))):
+            if "-->" in lines[i]:
+                timing = parse_timing(lines[i])
+                if timing is not None:
+                    return i, timing
+        return 0, None
+
+    def __read_text(self, file_path: str) -> str:
+        with open(file_path, 'rb') as file:
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped.
+                return ""
+
+            with data:
+                return self.__decode(data)[0]
+
+    def detect_encoding(self, data) -> str:
+        # The encoding __decode reads the file with.
+        return self.__decode(data)[1]
+
+    def __decode(self, data) -> Tuple[str, str]:
+        # The text and the encoding it was read with: the one a BOM names,
+        # else the first of self.encodings that decodes it all, else latin-1,
+        # which accepts any bytes.
+        view = memoryview(data)
+        try:
+            head = bytes(view[:4])
+            for bom, encoding in BOMS:
+                if head.startswith(bom):
+                    # utf-8-sig strips its own BOM; utf-16 needs it to pick the byte order.
+                    return str(view, encoding), encoding
+
+            for encoding in self.encodings:
+                try:
+                    return str(view, encoding), encoding
+                except UnicodeDecodeError:
+                    continue
+
+            return str(view, "latin-1"), "latin-1"
+        finally:
+            view.release()
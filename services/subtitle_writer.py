@@ -0,0 +1,98 @@
+import os
+import tempfile
+import time
+from typing import Iterable, List
+from models.subtitle_track import Cue
+from utils.metrics import stage_seconds
+from utils.timestamp import format_timing
+
+FORMATS = ("srt", "vtt")
+
+
+def _umask() -> int:
+    # The umask can only be read by setting it.
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# mkstemp creates files readable by the owner only; outputs get the mode an
+# ordinary open() would give them, so e.g. a media server running as another
+# user can still read them. Read once at import, before any threads start.
+FILE_MODE = 0o666 & ~_umask()
+
+
+class SubtitleWriter:
+    # Writes a stream of cues without holding the whole file in memory. Cues
+    # are formatted into a list of strings that is joined, encoded and written
+    # once it holds chunk_size characters, then reused. The output goes to a
+    # temp file in the same directory that is fsynced and renamed over the
+    # target, so readers only ever see the old file or the complete new one.
+    def __init__(self, format: str = "srt", chunk_size: int = 1 << 20) -> None:
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported subtitle format: {format!r}")
+        self.format = format
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def for_path(cls, path: str) -> "SubtitleWriter":
+        return cls("vtt" if path.lower().endswith(".vtt") else "srt")
+
+    def write(self, path: str, cues: Iterable[Cue]) -> int:
+        started = time.perf_counter()
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=f".{self.format}.tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                os.fchmod(file.fileno(), FILE_MODE)
+                count = self.__write_cues(file, cues)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        self.__sync_directory(directory)
+        stage_seconds.observe(time.perf_counter() - started, stage="write")
+        return count
+
+    def __write_cues(self, file, cues: Iterable[Cue]) -> int:
+        buffer: List[str] = []
+        size = 0
+        count = 0
+        separator = "," if self.format == "srt" else "."
+
+        if self.format == "vtt":
+            buffer.append("WEBVTT\n\n")
+
+        for index, start, end, text in cues:
+            block = f"{index}\n{format_timing(start, end, separator)}\n{text}\n\n"
+            buffer.append(block)
+            size += len(block)
+            count += 1
+            if size >= self.chunk_size:
+                file.write("".join(buffer).encode("utf-8"))
+                buffer.clear()
+                size = 0
+
+        if buffer:
+            file.write("".join(buffer).encode("utf-8"))
+        return count
+
+    def __sync_directory(self, directory: str) -> None:
+        # Makes the rename itself durable. Not every platform lets a directory
+        # be opened, which only costs durability, not correctness.
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
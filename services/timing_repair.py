@@ -0,0 +1,205 @@
+import time
+from typing import Callable, Iterable, List, NamedTuple, Optional, Sequence
+import numpy as np
+from models.subtitle_track import Cue, SubtitleTrack
+from utils.instrumentation import counters
+from utils.metrics import stage_seconds
+
+# How overlapping cues are fixed: "trim" ends each cue where the next one
+# starts, "merge" joins every run of overlapping cues into one cue showing all
+# their lines, and "keep" leaves them stacked on screen.
+OVERLAP_MODES = ("trim", "merge", "keep")
+
+
+class RepairOptions(NamedTuple):
+    shift_ms: int = 0
+    scale: float = 1.0
+    overlap: str = "trim"
+    # Short cues are lengthened to this, as far as the next cue allows.
+    min_duration_ms: int = 500
+    # Space kept between consecutive cues (about one frame at 24 fps).
+    min_gap_ms: int = 40
+    # Drop empty cues and join repeats of the same line.
+    compact: bool = True
+    # Show a merge cue once, not under every base cue it was matched to.
+    dedupe: bool = True
+
+
+class CueArrays(NamedTuple):
+    starts: np.ndarray
+    ends: np.ndarray
+    texts: List[str]
+
+
+Step = Callable[[CueArrays], CueArrays]
+
+
+class TimingRepair:
+    # Fixes the timings of a track as a chain of steps, each a linear pass of
+    # whole-array operations over the start and end milliseconds; only the
+    # text of joined cues is built cue by cue. The chain built from the
+    # options runs shift/scale, sort, compaction, overlaps, minimum duration
+    # and minimum gap, in that order; run() also takes any other chain of the
+    # step methods.
+    def __init__(self, options: RepairOptions = RepairOptions()) -> None:
+        if options.overlap not in OVERLAP_MODES:
+            raise ValueError(f"Unknown overlap mode {options.overlap!r}, expected one of {', '.join(OVERLAP_MODES)}")
+        self.options = options
+        self.steps: List[Step] = self.__build_steps()
+
+    def run(self, cues: CueArrays, steps: Optional[Sequence[Step]] = None) -> CueArrays:
+        for step in self.steps if steps is None else steps:
+            cues = step(cues)
+        return cues
+
+    def repair_cues(self, cues: Iterable[Cue], file_path: str = "") -> List[Cue]:
+        # Cues come out renumbered from 1, as steps may join or drop some.
+        started = time.perf_counter()
+        starts, ends, texts = [], [], []
+        for _, start, end, text in cues:
+            starts.append(start)
+            ends.append(end)
+            texts.append(text)
+        repaired = self.run(CueArrays(np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64), texts))
+        result = list(zip(range(1, len(repaired.texts) + 1), repaired.starts.tolist(), repaired.ends.tolist(), repaired.texts))
+
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage="repair")
+        counters.add(file_path, repair_ms=round(elapsed * 1000), repaired_cues=len(texts) - len(result))
+        return result
+
+    def repair_track(self, track: SubtitleTrack) -> SubtitleTrack:
+        repaired = self.run(CueArrays(
+            np.frombuffer(track.starts, dtype=np.int32).astype(np.int64),
+            np.frombuffer(track.ends, dtype=np.int32).astype(np.int64),
+            list(track.texts()),
+        ))
+        new_track = SubtitleTrack()
+        new_track.extend(zip(range(1, len(repaired.texts) + 1), repaired.starts.tolist(), repaired.ends.tolist(), repaired.texts))
+        return new_track
+
+    def repeats(self, columns: Sequence[Sequence[Optional[int]]]) -> List[np.ndarray]:
+        # For each alignment column, which base cues were matched to the same
+        # merge cue as the base cue before them. A merge cue spanning several
+        # base cues is then shown under the first one only, rather than its
+        # line repeating as the base lines change.
+        masks = []
+        for column in columns:
+            matches = np.array([-1 if match is None else match for match in column], dtype=np.int64)
+            repeated = np.zeros(len(matches), dtype=bool)
+            repeated[1:] = (matches[1:] == matches[:-1]) & (matches[1:] >= 0)
+            masks.append(repeated)
+        return masks
+
+    def shift(self, cues: CueArrays) -> CueArrays:
+        # t * scale + shift, for resyncing a whole file. Cues moved entirely
+        # before zero are dropped and the rest clipped to start at zero.
+        starts = np.rint(cues.starts * self.options.scale + self.options.shift_ms).astype(np.int64)
+        ends = np.rint(cues.ends * self.options.scale + self.options.shift_ms).astype(np.int64)
+        keep = ends > 0
+        return self.__select(CueArrays(np.maximum(starts, 0), ends, cues.texts), keep)
+
+    def sort(self, cues: CueArrays) -> CueArrays:
+        if np.all(cues.starts[1:] >= cues.starts[:-1]):
+            return cues
+        order = np.argsort(cues.starts, kind="stable")
+        return CueArrays(cues.starts[order], cues.ends[order], [cues.texts[i] for i in order.tolist()])
+
+    def trim_overlaps(self, cues: CueArrays) -> CueArrays:
+        # Starts are sorted, so the next cue's start is the earliest a cue can
+        # be overlapped by. Cues starting together are left as they are.
+        ends = cues.ends.copy()
+        next_starts = cues.starts[1:]
+        trim = (next_starts < ends[:-1]) & (next_starts > cues.starts[:-1])
+        ends[:-1][trim] = next_starts[trim]
+        return CueArrays(cues.starts, ends, cues.texts)
+
+    def merge_overlaps(self, cues: CueArrays) -> CueArrays:
+        # A cue starts a new group unless it starts before every earlier cue
+        # of the current group has ended.
+        if len(cues.texts) < 2:
+            return cues
+        reach = np.maximum.accumulate(cues.ends)
+        first = np.ones(len(cues.texts), dtype=bool)
+        first[1:] = cues.starts[1:] >= reach[:-1]
+        return self.__join(cues, first, self.__lines)
+
+    def compact(self, cues: CueArrays) -> CueArrays:
+        # Drops empty and zero-length cues, then joins a line repeated in
+        # consecutive cues less than the minimum gap apart into one cue.
+        keep = (cues.ends > cues.starts) & np.array([bool(text.strip()) for text in cues.texts], dtype=bool)
+        cues = self.__select(cues, keep)
+        if len(cues.texts) < 2:
+            return cues
+        texts = cues.texts
+        same = np.array([texts[i] == texts[i - 1] for i in range(1, len(texts))], dtype=bool)
+        first = np.ones(len(texts), dtype=bool)
+        first[1:] = ~(same & (cues.starts[1:] - cues.ends[:-1] <= self.options.min_gap_ms))
+        return self.__join(cues, first, lambda texts: texts[0])
+
+    def fix_short(self, cues: CueArrays) -> CueArrays:
+        # Lengthens cues under the minimum duration up to it, but never past
+        # the minimum gap before the next cue. A cue still too short (the
+        # next one starts right after it) is joined with the next one instead
+        # of flashing by.
+        limit = self.__next_starts(cues) - self.options.min_gap_ms
+        target = np.minimum(cues.starts + self.options.min_duration_ms, limit)
+        ends = np.maximum(cues.ends, target)
+        short = ends - cues.starts < self.options.min_duration_ms
+        first = np.ones(len(cues.texts), dtype=bool)
+        first[1:] = ~short[:-1]
+        return self.__join(CueArrays(cues.starts, ends, cues.texts), first, self.__lines)
+
+    def enforce_gap(self, cues: CueArrays) -> CueArrays:
+        # Ends cues the minimum gap before the next one starts, unless that
+        # would leave nothing of the cue.
+        limit = np.minimum(cues.ends, self.__next_starts(cues) - self.options.min_gap_ms)
+        return CueArrays(cues.starts, np.where(limit > cues.starts, limit, cues.ends), cues.texts)
+
+    def __build_steps(self) -> List[Step]:
+        options = self.options
+        steps: List[Step] = []
+        if options.shift_ms or options.scale != 1.0:
+            steps.append(self.shift)
+        steps.append(self.sort)
+        if options.compact:
+            steps.append(self.compact)
+        if options.overlap == "trim":
+            steps.append(self.trim_overlaps)
+        elif options.overlap == "merge":
+            steps.append(self.merge_overlaps)
+        if options.min_duration_ms > 0:
+            steps.append(self.fix_short)
+        if options.min_gap_ms > 0:
+            steps.append(self.enforce_gap)
+        return steps
+
+    def __join(self, cues: CueArrays, first: np.ndarray, join_texts: Callable[[List[str]], str]) -> CueArrays:
+        # Joins each run of cues starting at a True in first into one cue
+        # spanning all of them.
+        bounds = np.flatnonzero(first)
+        if len(bounds) == len(cues.texts):
+            return cues
+        ends = np.maximum.reduceat(cues.ends, bounds)
+        limits = bounds.tolist() + [len(cues.texts)]
+        texts = [
+            cues.texts[lo] if hi - lo == 1 else join_texts(cues.texts[lo:hi])
+            for lo, hi in zip(limits, limits[1:])
+        ]
+        return CueArrays(cues.starts[bounds], ends, texts)
+
+    @staticmethod
+    def __lines(texts: List[str]) -> str:
+        # Each distinct text once, in order.
+        return "\n".join(dict.fromkeys(texts))
+
+    @staticmethod
+    def __select(cues: CueArrays, keep: np.ndarray) -> CueArrays:
+        if keep.all():
+            return cues
+        return CueArrays(cues.starts[keep], cues.ends[keep], [text for text, kept in zip(cues.texts, keep.tolist()) if kept])
+
+    @staticmethod
+    def __next_starts(cues: CueArrays) -> np.ndarray:
+        # The last cue has no next one to run into.
+        return np.append(cues.starts[1:], np.iinfo(np.int64).max // 2)
@@ -0,0 +1,59 @@
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import DefaultDict, Dict, List, Tuple
+from utils.metrics import events_total
+
+
+class Counters:
+    # Per-file event counts (cues parsed, matches, misses, ...) collected in the
+    # hot loops instead of logging each event, and reported once per run.
+    # Counts named *_ms are time spent on the file, which the summary uses to
+    # point out the slowest files; the rest are also exported as metrics.
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__totals: Counter = Counter()
+        self.__per_file: DefaultDict[str, Counter] = defaultdict(Counter)
+
+    def add(self, file_path: str, **counts: int) -> None:
+        with self.__lock:
+            self.__totals.update(counts)
+            self.__per_file[file_path].update(counts)
+        for name, count in counts.items():
+            if not name.endswith("_ms"):
+                events_total.inc(count, event=name)
+
+    def totals(self) -> Dict[str, int]:
+        with self.__lock:
+            return dict(self.__totals)
+
+    def per_file(self) -> Dict[str, Dict[str, int]]:
+        with self.__lock:
+            return {path: dict(counts) for path, counts in self.__per_file.items()}
+
+    def slowest(self, name: str, n: int = 5) -> List[Tuple[str, int]]:
+        with self.__lock:
+            ranked = [(path, counts[name]) for path, counts in self.__per_file.items() if counts[name]]
+        ranked.sort(key=lambda item: -item[1])
+        return ranked[:n]
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__totals.clear()
+            self.__per_file.clear()
+
+    def log_summary(self, logger: logging.Logger, title: str = "Run summary") -> None:
+        totals = self.totals()
+        if not totals:
+            return
+        per_file = self.per_file()
+        logger.info("%s: %s across %d files", title, ", ".join(f"{name}={count}" for name, count in sorted(totals.items())), len(per_file))
+        for name in sorted(totals):
+            if name.endswith("_ms"):
+                logger.info("Slowest by %s: %s", name, ", ".join(f"{path} ({ms}ms)" for path, ms in self.slowest(name)))
+        if logger.isEnabledFor(logging.DEBUG):
+            for path, counts in per_file.items():
+                logger.debug("%s: %s", path, ", ".join(f"{name}={count}" for name, count in sorted(counts.items())))
+
+
+counters = Counters()
@@ -1,16 +1,25 @@
+import atexit
 import logging
+import os
+import queue
 import sys
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from logging.handlers import QueueListener
 
 LOG_FILE = "subtitle_merger.log"
 LOGGER_NAME = "media_library"
 
+_queue_listener: Optional["QueueListener"] = None
+
 def get_logger():
     logger = logging.getLogger(LOGGER_NAME)
     if not logger.hasHandlers():
         logger.setLevel(logging.INFO)
 
-        # File handler
-        file_handler = logging.FileHandler(LOG_FILE, mode='a', encoding='utf-8')
+        # File handler; the file is opened on the first record, not on import
+        file_handler = logging.FileHandler(LOG_FILE, mode='a', encoding='utf-8', delay=True)
         file_formatter = logging.Formatter(
             "%(asctime)s [%(levelname)s] %(message)s",
             datefmt="%Y-%m-%d %H:%M:%S"
@@ -26,4 +35,44 @@ def get_logger():
     return logger
 
 
+def enable_queue_logging() -> "QueueListener":
+    # Moves the file handler behind a QueueHandler so worker threads only
+    # enqueue records and a background listener does the formatting and
+    # disk writes.
+    global _queue_listener
+    from logging.handlers import QueueHandler, QueueListener
+    if _queue_listener is not None:
+        return _queue_listener
+
+    file_handlers = [handler for handler in logger.handlers if isinstance(handler, logging.FileHandler)]
+    for handler in file_handlers:
+        logger.removeHandler(handler)
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    logger.addHandler(queue_handler)
+    _queue_listener = QueueListener(records, *file_handlers, respect_handler_level=True)
+    _queue_listener.start()
+    atexit.register(_queue_listener.stop)
+
+    # The listener thread does not survive a fork, so forked workers (e.g. the
+    # batch merge pool) write to the file handlers directly again. Their
+    # streams are dropped and reopened on the next record, because the fork
+    # may have happened while the listener held the stream's buffer lock.
+    def restore_in_child() -> None:
+        global _queue_listener
+        logger.removeHandler(queue_handler)
+        for handler in file_handlers:
+            handler.stream = None
+            logger.addHandler(handler)
+        _queue_listener = None
+
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=restore_in_child)
+    return _queue_listener
+
+
 logger = get_logger()
+
+if os.environ.get("MEEDYA_LOG_QUEUE") == "1":
+    enable_queue_logging()
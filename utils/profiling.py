@@ -0,0 +1,78 @@
+import cProfile
+import logging
+import os
+import pstats
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from multiprocessing import util
+from typing import DefaultDict, Dict, Iterator, Optional
+
+# Entries listed in the text reports next to each dump.
+TOP_ENTRIES = 30
+
+
+@contextmanager
+def profiled(directory: Optional[str], name: str, trace_memory: bool = False) -> Iterator[None]:
+    # Profiles the block with cProfile, and optionally tracemalloc, and dumps
+    # the results to directory as <name>.prof plus text reports. Does nothing
+    # without a directory, so callers can wrap their work unconditionally.
+    if directory is None:
+        yield
+        return
+
+    profile = _start(trace_memory)
+    try:
+        yield
+    finally:
+        _dump(profile, directory, name, trace_memory)
+
+
+def profile_worker(directory: str, trace_memory: bool = False) -> None:
+    # For pool initializers: profiles the rest of the worker process's life.
+    # Pool workers leave through os._exit, which skips atexit, but
+    # multiprocessing runs its own finalizers first.
+    profile = _start(trace_memory)
+    util.Finalize(None, _dump, args=(profile, directory, f"worker-{os.getpid()}", trace_memory), exitpriority=10)
+
+
+def log_breakdown(logger: logging.Logger, per_file: Dict[str, Dict[str, int]], root: str, top: int = 10) -> None:
+    # Time per show or movie folder (the first path component under root),
+    # from the *_ms counts in utils.instrumentation.
+    by_folder: DefaultDict[str, Counter] = defaultdict(Counter)
+    for path, counts in per_file.items():
+        relative = os.path.relpath(path, root)
+        folder = relative.split(os.sep, 1)[0] if not relative.startswith("..") else path
+        by_folder[folder].update({name: count for name, count in counts.items() if name.endswith("_ms")})
+
+    ranked = sorted(by_folder.items(), key=lambda item: -sum(item[1].values()))
+    for folder, counts in ranked[:top]:
+        if counts:
+            logger.info("%s: %dms (%s)", folder, sum(counts.values()), ", ".join(f"{name}={ms}" for name, ms in sorted(counts.items())))
+
+
+def _start(trace_memory: bool) -> cProfile.Profile:
+    if trace_memory:
+        tracemalloc.start()
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def _dump(profile: cProfile.Profile, directory: str, name: str, trace_memory: bool) -> None:
+    profile.disable()
+    # Snapshot first, so writing the reports is not part of it.
+    snapshot = tracemalloc.take_snapshot() if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, name)
+    profile.dump_stats(f"{base}.prof")
+    with open(f"{base}.txt", "w", encoding="utf-8") as report:
+        pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(TOP_ENTRIES)
+
+    if snapshot is not None:
+        with open(f"{base}.memory.txt", "w", encoding="utf-8") as report:
+            for stat in snapshot.statistics("lineno")[:TOP_ENTRIES]:
+                report.write(f"{stat}\n")
@@ -0,0 +1,88 @@
+import os
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
+
+# S01E07, s1e7, S01.E07, S01_E07, and 1x07. The second form needs a
+# boundary on both sides so resolutions like 1920x1080 are not read as one.
+EPISODE_RE = re.compile(r"[Ss](\d{1,2})[ ._-]?[Ee](\d{1,3})|(?<![0-9A-Za-z])(\d{1,2})x(\d{2,3})(?![0-9])")
+SEPARATORS_RE = re.compile(r"[\s._-]+")
+
+SUBTITLE_EXTS = (".srt", ".vtt")
+
+# ISO 639-1 codes and the ISO 639-2 codes releases commonly use. A tag may
+# carry a region or script ("pt-BR", "zh-Hans") or our own "_combined" suffix.
+LANGUAGE_CODES = frozenset("""
+    aa ab af ak am an ar as av ay az ba be bg bh bi bm bn bo br bs ca ce ch co cr cs cu cv cy da de dv dz ee el en
+    eo es et eu fa ff fi fj fo fr fy ga gd gl gn gu gv ha he hi ho hr ht hu hy hz ia id ie ig ii ik io is it iu ja
+    jv ka kg ki kj kk kl km kn ko kr ks ku kv kw ky la lb lg li ln lo lt lu lv mg mh mi mk ml mn mr ms mt my na nb
+    nd ne ng nl nn no nr nv ny oc oj om or os pa pi pl ps pt qu rm rn ro ru rw sa sc sd se sg si sk sl sm sn so sq
+    sr ss st su sv sw ta te tg th ti tk tl tn to tr ts tt tw ty ug uk ur uz ve vi vo wa wo xh yi yo za zh zu
+    ara bul ces chi chs cht cze dan deu dut ell eng est fas fil fin fra fre ger gre heb hin hrv hun ind ita jpn
+    kor lav lit may msa nld nor per pol por ron rum rus slk slo slv spa srp swe tgl tha tur ukr vie zho
+""".split())
+LANGUAGE_TAG_RE = re.compile(r"([A-Za-z]{2,3})(?:[-_][0-9A-Za-z]+)*")
+# Variants written after the language, as in "en.sdh".
+TAG_MODIFIERS = frozenset(("sdh", "hi", "cc", "forced", "default"))
+
+
+class ReleaseName(NamedTuple):
+    # stem is the file name without extension and language tag, which is what
+    # a subtitle shares with its video when both are named alike.
+    stem: str
+    show: Optional[str]
+    season: Optional[int]
+    episode: Optional[int]
+    language: Optional[str]
+
+    @property
+    def episode_key(self) -> Optional[Tuple[int, int]]:
+        return (self.season, self.episode) if self.episode is not None else None
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_release_name(filename: str) -> ReleaseName:
+    # "House.S01E21.720p.HDTV.en.srt" -> stem "House.S01E21.720p.HDTV",
+    # show "House", season 1, episode 21, language "en". The language is
+    # only looked for on subtitle files. A trailing tag that is not a
+    # language code ("English", "简体") is still taken as the language, so
+    # such files stay in the library; the episode is then also looked for in
+    # that tag, for names like "House.S01E21.srt".
+    name, ext = os.path.splitext(filename)
+    stem, language = name, None
+    if ext.lower() in SUBTITLE_EXTS:
+        stem, language = split_language(name)
+        if language is None and "." in name:
+            parts = name.split(".")
+            tag_parts = 2 if len(parts) > 2 and parts[-1].lower() in TAG_MODIFIERS else 1
+            stem, language = ".".join(parts[:-tag_parts]), ".".join(parts[-tag_parts:])
+
+    match = EPISODE_RE.search(stem) or EPISODE_RE.search(name)
+    if not match:
+        return ReleaseName(stem, None, None, None, language)
+    season, episode = (int(group) for group in match.groups() if group is not None)
+    show = SEPARATORS_RE.sub(" ", stem[:match.start()]).strip() or None
+    return ReleaseName(stem, show, season, episode, language)
+
+
+def split_language(stem: str) -> Tuple[str, Optional[str]]:
+    # The trailing dotted part that names a language, plus a variant after it.
+    parts = stem.split(".")
+    if len(parts) > 2 and parts[-1].lower() in TAG_MODIFIERS and _is_language(parts[-2]):
+        return ".".join(parts[:-2]), ".".join(parts[-2:])
+    if len(parts) > 1 and _is_language(parts[-1]):
+        return ".".join(parts[:-1]), parts[-1]
+    return stem, None
+
+
+def episode_code(name: str) -> Optional[str]:
+    match = EPISODE_RE.search(name)
+    if not match:
+        return None
+    season, episode = (int(group) for group in match.groups() if group is not None)
+    return f"S{season:02d}E{episode:02d}"
+
+
+def _is_language(tag: str) -> bool:
+    match = LANGUAGE_TAG_RE.fullmatch(tag)
+    return match is not None and match.group(1).lower() in LANGUAGE_CODES
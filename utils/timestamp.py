@@ -0,0 +1,33 @@
+import re
+from typing import Optional, Tuple
+
+TIMING_RE = re.compile(r"(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})")
+
+
+def timestamp_to_ms(timestamp: str) -> int:
+    h, m, s_ms = timestamp.strip().split(":")
+    s, ms = s_ms.replace(".", ",").split(",")
+    return (int(h) * 3600 + int(m) * 60 + int(s)) * 1000 + int(ms.ljust(3, "0"))
+
+
+def ms_to_timestamp(ms: int, separator: str = ",") -> str:
+    ms = max(ms, 0)
+    h, rest = divmod(ms, 3_600_000)
+    m, rest = divmod(rest, 60_000)
+    s, ms = divmod(rest, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d}{separator}{ms:03d}"
+
+
+def parse_timing(line: str) -> Optional[Tuple[int, int]]:
+    match = TIMING_RE.search(line)
+    if not match:
+        return None
+    h1, m1, s1, ms1, h2, m2, s2, ms2 = match.groups()
+    start = (int(h1) * 3600 + int(m1) * 60 + int(s1)) * 1000 + int(ms1.ljust(3, "0"))
+    end = (int(h2) * 3600 + int(m2) * 60 + int(s2)) * 1000 + int(ms2.ljust(3, "0"))
+    return start, end
+
+
+# SRT separates milliseconds with a comma, WebVTT with a dot.
+def format_timing(start: int, end: int, separator: str = ",") -> str:
+    return f"{ms_to_timestamp(start, separator)} --> {ms_to_timestamp(end, separator)}"